@@ -4,7 +4,10 @@ import tkinter as tk
 from tkinter import filedialog, ttk, Frame
 import os
 import time
-import heapq  # For priority queue optimization
+import heapq  # compiled by numba for the merge heap of connectivity_ward
+import hashlib
+from collections import OrderedDict
+from numba import jit, prange
 import cv2  # For better color space handling
 from sklearn.preprocessing import StandardScaler  # For normalizing pixel values
 from sklearn.cluster import AgglomerativeClustering  # For built-in clustering
@@ -295,61 +298,477 @@ def downsample_image(image, max_size=100):  # Increased size for better quality
         return image.resize(new_size, Image.LANCZOS)
     return image
 
-def euclidean_distance(p1, p2):
-    """Calculate Euclidean distance between two points"""
-    return np.sqrt(np.sum((p1 - p2) ** 2))
-
-def calculate_initial_distances(data):
-    """Calculate initial pairwise distances between clusters more efficiently"""
-    n = len(data)
-    # Use a heap to store distances efficiently
-    distances = []
-    
-    for i in range(n):
-        for j in range(i+1, n):
-            dist = euclidean_distance(data[i], data[j])
-            # Store as (distance, i, j) for heapq
-            heapq.heappush(distances, (dist, i, j))
-            
-    return distances
+# The chain is run in this many slices of equal work, reporting progress after each
+NN_CHAIN_PROGRESS_STEPS = 20
 
-def ward_linkage_distance_optimized(c1_size, c2_size, c1_center, c2_center):
-    """Optimized Ward's linkage criterion using pre-calculated centroids"""
-    if c1_size == 0 or c2_size == 0:
-        return float('inf')
-    
-    # Ward's criterion formula
-    return ((c1_size * c2_size) / (c1_size + c2_size)) * euclidean_distance(c1_center, c2_center)**2
+def nn_chain_ward(points, progress_callback=None, progress_start=10, progress_end=90):
+    """
+    Ward clustering with the nearest-neighbour chain: follow nearest neighbours from any cluster
+    until two clusters are each other's nearest neighbour, merge them, and continue from the rest
+    of the chain. Ward's criterion is reducible, so this finds the same merges as always merging
+    the globally closest pair, in O(n^2) time. Distances come from cluster sizes and centroids, so
+    memory is O(n).
+    Returns merges (n-1, 3): two points, one from each merged cluster, and the Ward cost of the merge,
+    in the order the chain found them (not sorted)
+    """
+    n, dimensions = points.shape
+    centroids = points.astype(np.float64).copy()
+    sizes = np.ones(n, dtype=np.float64)
+    # the active clusters, each stored in the slot of one of its points
+    active_slots = np.arange(n)
+    slot_positions = np.arange(n)
+    merges = np.empty((max(n - 1, 0), 3), dtype=np.float64)
+    chain = np.empty(n, dtype=np.int64)
+    chain_length = 0
+
+    # A merge costs O(active clusters), so slices with equal work get shorter as clusters disappear
+    steps = np.arange(1, NN_CHAIN_PROGRESS_STEPS + 1) / NN_CHAIN_PROGRESS_STEPS
+    slice_ends = np.minimum(np.ceil(n - n * np.sqrt(1 - steps)).astype(np.int64), max(n - 1, 0))
+    start = 0
+    for step, end in zip(steps, slice_ends):
+        chain_length = nn_chain_merges(centroids, sizes, active_slots, slot_positions, chain, chain_length, merges, start, end)
+        start = end
+        if progress_callback:
+            progress_callback(progress_start + (progress_end - progress_start) * step)
+
+    return merges
+
+@jit(nopython=True)
+def nn_chain_merges(centroids, sizes, active_slots, slot_positions, chain, chain_length, merges, start, end):
+    # Merges start..end-1 of the chain, the state arrays are updated in place; returns the new chain length
+    n, dimensions = centroids.shape
+    for merge in range(start, end):
+        number_active = n - merge
+        while True:
+            if chain_length == 0:
+                chain[0] = active_slots[0]
+                chain_length = 1
+            current = chain[chain_length - 1]
+            previous = chain[chain_length - 2] if chain_length > 1 else -1
+
+            # the previous cluster of the chain wins ties, which guarantees the chain ends
+            nearest = previous
+            nearest_cost = ward_cost(centroids, sizes, current, previous) if previous >= 0 else np.inf
+            for position in range(number_active):
+                candidate = active_slots[position]
+                if candidate != current:
+                    cost = ward_cost(centroids, sizes, current, candidate)
+                    if cost < nearest_cost:
+                        nearest_cost = cost
+                        nearest = candidate
+
+            if nearest == previous:
+                break
+            chain[chain_length] = nearest
+            chain_length += 1
+
+        # current and previous are reciprocal nearest neighbours: merge previous into current
+        chain_length -= 2
+        merges[merge, 0] = current
+        merges[merge, 1] = previous
+        merges[merge, 2] = nearest_cost
+        merged_size = sizes[current] + sizes[previous]
+        for d in range(dimensions):
+            centroids[current, d] = (sizes[current] * centroids[current, d] + sizes[previous] * centroids[previous, d]) / merged_size
+        sizes[current] = merged_size
+
+        # swap-remove previous from the active clusters
+        position = slot_positions[previous]
+        active_slots[position] = active_slots[n - merge - 1]
+        slot_positions[active_slots[position]] = position
+
+    return chain_length
+
+@jit(nopython=True)
+def ward_cost(centroids, sizes, a, b):
+    # increase of the within-cluster sum of squares when clusters a and b are merged
+    distance = 0.0
+    for d in range(centroids.shape[1]):
+        difference = centroids[a, d] - centroids[b, d]
+        distance += difference * difference
+    return sizes[a] * sizes[b] / (sizes[a] + sizes[b]) * distance
+
+def cut_merges(merges, n, n_clusters):
+    """
+    Labels 0..n_clusters-1 of the n points after the first n - n_clusters merges (rows of merges in
+    merge order). Each merge joins the clusters of its two points, so a union-find over the points
+    is enough
+    """
+    roots = merge_roots(merges, n, max(0, min(n - n_clusters, len(merges))))
+    # number the roots in increasing order without sorting, so the whole cut stays O(n)
+    is_root = np.zeros(n, dtype=np.int64)
+    is_root[roots] = 1
+    return (np.cumsum(is_root) - 1)[roots]
+
+@jit(nopython=True)
+def merge_roots(merges, n, number_of_merges):
+    parents = np.arange(n)
+    for merge in range(number_of_merges):
+        a = find_root(parents, int(merges[merge, 0]))
+        b = find_root(parents, int(merges[merge, 1]))
+        parents[max(a, b)] = min(a, b)
+    for point in range(n):
+        parents[point] = find_root(parents, point)
+    return parents
+
+@jit(nopython=True)
+def find_root(parents, point):
+    root = point
+    while parents[root] != root:
+        root = parents[root]
+    while parents[point] != root:  # path compression
+        parents[point], point = root, parents[point]
+    return root
+
+def pixel_features(img_array):
+    """Weighted LAB features of every pixel, as used by the clustering"""
+    h, w, c = img_array.shape
+    img_lab = cv2.cvtColor(img_array, cv2.COLOR_RGB2LAB)
+    weights = np.array([1.0, 2.0, 2.0])  # Give more weight to color than luminance
+    scale = np.array([100.0, 127.0, 127.0])  # LAB value ranges
+    return (img_lab.reshape(-1, c).astype(float) / scale) * weights
+
+# The connectivity merges are run in this many slices of equal length, reporting progress after each
+CONNECTIVITY_PROGRESS_STEPS = 20
+
+def connectivity_ward(features, height, width, connectivity=4, progress_callback=None, progress_start=10, progress_end=90):
+    """
+    Ward clustering where only neighbouring clusters may merge: the pixels start as clusters linked
+    to their 4 or 8 grid neighbours, and a merged cluster is linked to the neighbours of both parts.
+    Candidate pairs wait in a heap; entries are never removed, they are skipped when popped if one
+    side was merged away or the cost changed since they were pushed (lazy invalidation). Each
+    merge costs O(degree of the new cluster log heap) instead of a pass over all clusters.
+    Returns the merges (rows: two points, one from each side, and the Ward cost) in merge order
+    """
+    n = features.shape[0]
+    merges = np.empty((max(n - 1, 0), 3), dtype=np.float64)
+    slice_length = max(1, -(-(n - 1) // CONNECTIVITY_PROGRESS_STEPS))
+
+    number_of_merges = 0
+    for number_of_merges in connectivity_merges(features, height, width, connectivity, merges, slice_length):
+        if progress_callback:
+            progress_callback(progress_start + (progress_end - progress_start) * number_of_merges / max(n - 1, 1))
+
+    return merges[:number_of_merges]
+
+@jit(nopython=True)
+def connectivity_merges(features, height, width, connectivity, merges, slice_length):
+    """
+    The merge loop of connectivity_ward as a generator: the merges are written into merges and the
+    count so far is yielded every slice_length merges and at the end. Being compiled, the generator
+    keeps the heap and the neighbour lists between slices without converting them back to Python
+    """
+    n, dimensions = features.shape
+    centroids = features.copy()
+    sizes = np.ones(n, dtype=np.float64)
+    parents = np.arange(n)
+
+    if connectivity == 8:
+        offsets = np.array([(0, 1), (1, 0), (1, 1), (1, -1)])
+    else:
+        offsets = np.array([(0, 1), (1, 0)])
+
+    # neighbour lists as linked lists of nodes, so two lists are joined in O(1) on a merge
+    number_of_nodes = 2 * n * offsets.shape[0]
+    node_neighbour = np.empty(number_of_nodes, dtype=np.int64)
+    node_next = np.full(number_of_nodes, -1, dtype=np.int64)
+    heads = np.full(n, -1, dtype=np.int64)
+    tails = np.full(n, -1, dtype=np.int64)
+    heap = [(0.0, 0, 0)]
+    heap.pop()
+
+    node = 0
+    for y in range(height):
+        for x in range(width):
+            a = y * width + x
+            for k in range(offsets.shape[0]):
+                ny, nx = y + offsets[k, 0], x + offsets[k, 1]
+                if 0 <= ny < height and 0 <= nx < width:
+                    b = ny * width + nx
+                    for source, target in ((a, b), (b, a)):
+                        node_neighbour[node] = target
+                        if heads[source] == -1:
+                            heads[source] = node
+                        else:
+                            node_next[tails[source]] = node
+                        tails[source] = node
+                        node += 1
+                    heapq.heappush(heap, (pair_ward_cost(centroids, sizes, a, b), a, b))
+
+    seen = np.full(n, -1, dtype=np.int64)
+    number_of_merges = 0
+    while len(heap) > 0 and number_of_merges < n - 1:
+        cost, a, b = heapq.heappop(heap)
+        if parents[a] != a or parents[b] != b or cost != pair_ward_cost(centroids, sizes, a, b):
+            continue  # stale entry
+
+        merges[number_of_merges, 0] = a
+        merges[number_of_merges, 1] = b
+        merges[number_of_merges, 2] = cost
+        number_of_merges += 1
+
+        # b joins a
+        merged_size = sizes[a] + sizes[b]
+        for d in range(dimensions):
+            centroids[a, d] = (sizes[a] * centroids[a, d] + sizes[b] * centroids[b, d]) / merged_size
+        sizes[a] = merged_size
+        parents[b] = a
+        if heads[b] != -1:
+            if heads[a] == -1:
+                heads[a] = heads[b]
+            else:
+                node_next[tails[a]] = heads[b]
+            tails[a] = tails[b]
+
+        # resolve the joined list to current clusters, dropping duplicates and a itself,
+        # and queue the new pair costs
+        previous_node = -1
+        node = heads[a]
+        while node != -1:
+            next_node = node_next[node]
+            neighbour = find_root(parents, node_neighbour[node])
+            if neighbour == a or seen[neighbour] == number_of_merges:
+                if previous_node == -1:
+                    heads[a] = next_node
+                else:
+                    node_next[previous_node] = next_node
+            else:
+                node_neighbour[node] = neighbour
+                seen[neighbour] = number_of_merges
+                heapq.heappush(heap, (pair_ward_cost(centroids, sizes, a, neighbour), a, neighbour))
+                previous_node = node
+            node = next_node
+        tails[a] = previous_node
 
-def agglomerative_clustering_scratch(image, n_clusters=4, progress_callback=None, enhanced_output=True):
-    """Optimized agglomerative clustering with improved visual quality"""
+        if number_of_merges % slice_length == 0:
+            yield number_of_merges
+
+    if number_of_merges % slice_length != 0 or number_of_merges == 0:
+        yield number_of_merges
+
+@jit(nopython=True)
+def pair_ward_cost(centroids, sizes, a, b):
+    return ward_cost(centroids, sizes, a, b)
+
+def agglomerative_clustering_connectivity(image, n_clusters=4, connectivity=4, progress_callback=None):
+    """
+    Connectivity-constrained Ward clustering on the full-resolution pixels: only 4 or 8 neighbouring
+    pixels or regions merge, so every segment is a connected region and no pixel is sampled away.
+    Segments are painted with their mean RGB color; no smoothing is needed since the regions are
+    spatially coherent
+    """
+    if connectivity not in (4, 8):
+        raise ValueError("Invalid connectivity. Choose 4 or 8.")
+    start_time = time.time()
+
+    img_array = np.asarray(image)
+    h, w, c = img_array.shape
+    if progress_callback:
+        progress_callback(10)
+
+    # the complete merge tree is cached, so another n_clusters only re-cuts it
+    tree = cached_dendrogram(dendrogram_key(image_key(img_array), connectivity),
+                             lambda: Dendrogram(connectivity_ward(pixel_features(img_array), h, w, connectivity,
+                                                                  progress_callback), h * w))
+    if progress_callback:
+        progress_callback(90)
+
+    labels = tree.cut(n_clusters)
+    segmented_img = segment_colors(img_array.reshape(-1, c), labels).reshape(h, w, c)
+
+    if progress_callback:
+        progress_callback(100)
+    print(f"Connectivity clustering completed in {time.time() - start_time:.2f} seconds")
+    return segmented_img
+
+def cluster_means(points, labels):
+    # Mean of the points of every cluster, from per-cluster sums
+    counts = np.bincount(labels)
+    return np.column_stack([np.bincount(labels, weights=points[:, dimension]) / counts
+                            for dimension in range(points.shape[1])])
+
+@jit(nopython=True, parallel=True)
+def nearest_centroids(points, centroids):
+    """Label of the closest centroid for every point: one pass over the points, the few centroids stay in cache"""
+    labels = np.empty(len(points), dtype=np.int64)
+    for i in prange(len(points)):
+        best_distance = np.inf
+        best_label = 0
+        for j in range(len(centroids)):
+            distance = 0.0
+            for dimension in range(points.shape[1]):
+                difference = points[i, dimension] - centroids[j, dimension]
+                distance += difference * difference
+            if distance < best_distance:
+                best_distance = distance
+                best_label = j
+        labels[i] = best_label
+    return labels
+
+def segment_colors(rgb_pixels, labels):
+    # Every pixel takes the mean RGB color of its segment; labels with no pixels left (e.g. lost in
+    # label upsampling) get black instead of a 0/0, no pixel uses them anyway
+    counts = np.bincount(labels)
+    mean_colors = np.column_stack([np.divide(np.bincount(labels, weights=rgb_pixels[:, channel]), counts,
+                                             out=np.zeros(len(counts)), where=counts > 0)
+                                   for channel in range(rgb_pixels.shape[1])])
+    return mean_colors.astype(np.uint8)[labels]
+
+UPSAMPLING_MODES = ('bicubic', 'labels')
+
+def restore_resolution(original_img_array, small_img_array, labels, upsampling='bicubic', enhanced_output=True):
+    """
+    Segmented image at the original size from the labels of the downsampled pixels.
+    'bicubic' paints the small image and resizes the colors; 'labels' upsamples the label map
+    against the original image (joint bilateral) and paints the mean colors of the full-resolution
+    segments, so edges stay sharp without the smoothing filters. enhanced_output applies the
+    bilateral and edge-preserving filters on top
+    """
+    if upsampling not in UPSAMPLING_MODES:
+        raise ValueError("Invalid upsampling. Choose 'bicubic' or 'labels'.")
+    H, W, c = original_img_array.shape
+    h, w = small_img_array.shape[:2]
+
+    if upsampling == 'labels':
+        small_labels = labels.reshape(h, w).astype(np.int64)
+        if (h, w) != (H, W):
+            full_labels = joint_bilateral_label_upsampling(np.ascontiguousarray(original_img_array), np.ascontiguousarray(small_img_array),
+                                                           small_labels, small_labels.max() + 1)
+        else:
+            full_labels = small_labels
+        segmented_img = segment_colors(original_img_array.reshape(-1, c), full_labels.ravel()).reshape(H, W, c)
+    else:
+        segmented_img = segment_colors(small_img_array.reshape(-1, c), labels).reshape(h, w, c)
+        # Resize back to original size with better interpolation
+        if (h, w) != (H, W):
+            segmented_pil = Image.fromarray(segmented_img)
+            segmented_pil = segmented_pil.resize((W, H), Image.BICUBIC)
+            segmented_img = np.array(segmented_pil)
+
+    if enhanced_output:
+        # Apply more gentle post-processing for better visuals
+        # First, apply bilateral filter to smooth while preserving edges
+        segmented_img = cv2.bilateralFilter(segmented_img, 9, 75, 75)
+
+        # Then apply a more subtle edge-preserving filter
+        segmented_img = cv2.edgePreservingFilter(segmented_img, flags=1, sigma_s=45, sigma_r=0.3)
+
+    return segmented_img
+
+@jit(nopython=True, parallel=True)
+def joint_bilateral_label_upsampling(guide, small_guide, small_labels, n_labels, radius=2, sigma_spatial=1.0, sigma_color=20.0):
+    """
+    Every full-resolution pixel votes among the labels of the downsampled pixels around it: each
+    neighbour weighs by its distance (in small pixels) and by how close its color is to the pixel's
+    own color in the full-resolution guide, so label edges snap to the image edges
+    """
+    H, W = guide.shape[0], guide.shape[1]
+    h, w = small_labels.shape
+    full_labels = np.empty((H, W), dtype=np.int64)
+    scale_y, scale_x = h / H, w / W
+    spatial_factor = -0.5 / (sigma_spatial * sigma_spatial)
+    color_factor = -0.5 / (sigma_color * sigma_color)
+
+    for y in prange(H):
+        scores = np.zeros(n_labels)
+        sy = (y + 0.5) * scale_y - 0.5
+        cy = int(np.floor(sy))
+        for x in range(W):
+            sx = (x + 0.5) * scale_x - 0.5
+            cx = int(np.floor(sx))
+            y0, y1 = max(cy - radius + 1, 0), min(cy + radius + 1, h)
+            x0, x1 = max(cx - radius + 1, 0), min(cx + radius + 1, w)
+
+            # inside a segment every neighbour has the same label, only pixels near an edge need the vote
+            first_label = small_labels[y0, x0]
+            uniform = True
+            for qy in range(y0, y1):
+                for qx in range(x0, x1):
+                    if small_labels[qy, qx] != first_label:
+                        uniform = False
+            if uniform:
+                full_labels[y, x] = first_label
+                continue
+
+            scores[:] = 0.0
+            for qy in range(y0, y1):
+                for qx in range(x0, x1):
+                    color_distance = 0.0
+                    for channel in range(guide.shape[2]):
+                        difference = float(guide[y, x, channel]) - float(small_guide[qy, qx, channel])
+                        color_distance += difference * difference
+                    spatial_distance = (qy - sy) * (qy - sy) + (qx - sx) * (qx - sx)
+                    scores[small_labels[qy, qx]] += np.exp(spatial_factor * spatial_distance + color_factor * color_distance)
+
+            best_label = small_labels[min(max(int(sy + 0.5), 0), h - 1), min(max(int(sx + 0.5), 0), w - 1)]
+            best_score = 0.0
+            for label in range(n_labels):
+                if scores[label] > best_score:
+                    best_score = scores[label]
+                    best_label = label
+            full_labels[y, x] = best_label
+
+    return full_labels
+
+def agglomerative_clustering_scratch(image, n_clusters=4, progress_callback=None, enhanced_output=True, upsampling='bicubic'):
+    """Optimized agglomerative clustering with improved visual quality.
+    The whole merge tree is cached per image, so another n_clusters only re-cuts it.
+    upsampling='labels' with enhanced_output=False skips the full-resolution filters (see restore_resolution)"""
     start_time = time.time()
     
     # Store original image for later use
-    original_img_array = np.array(image)
+    original_img_array = np.asarray(image)
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
+    
+    tree, prepared = cached_dendrogram(dendrogram_key(image_key(original_img_array)),
+                                       lambda: scratch_dendrogram(image, progress_callback))
+    small_size, sampled_pixels, is_sampled = prepared['small_size'], prepared['sampled_pixels'], prepared['is_sampled']
+    pixels_normalized, rgb_pixels = prepared['pixels_normalized'], prepared['rgb_pixels']
+    w, h = small_size
+    c = rgb_pixels.shape[1]
+    n = len(pixels_normalized)
     
+    if progress_callback:
+        progress_callback(90)
+    
+    # Cut the tree at n_clusters
+    cluster_labels = tree.cut(n_clusters)
+    
+    # Map results back to original image size
+    if is_sampled:
+        # Assign each pixel to the nearest centroid of the sampled clusters, in a single pass
+        final_centroids = cluster_means(sampled_pixels, cluster_labels)
+        full_labels = nearest_centroids(pixels_normalized, final_centroids)
+    else:
+        # For non-sampled data, use existing labels
+        full_labels = cluster_labels
+    
+    # Segments painted with the mean of the original RGB values, at the original size
+    segmented_img = restore_resolution(original_img_array, rgb_pixels.reshape(h, w, c), full_labels, upsampling, enhanced_output)
+    
+    if progress_callback:
+        progress_callback(100)
+    
+    elapsed_time = time.time() - start_time
+    print(f"Clustering completed in {elapsed_time:.2f} seconds")
+    
+    return segmented_img
+
+def scratch_dendrogram(image, progress_callback=None):
+    """Downsampled, (sub)sampled LAB features of the image and their complete Ward merge tree"""
     # Downsample the image
     small_img = downsample_image(image, max_size=150)  # Increase size for better details
     
     # Convert to array and reshape
     img_array = np.array(small_img)
-    h, w, c = img_array.shape
     
-    # Convert to LAB color space for perceptually meaningful clustering
-    img_lab = cv2.cvtColor(img_array, cv2.COLOR_RGB2LAB)
-    pixels = img_lab.reshape(-1, c)
+    # Convert to LAB color space for perceptually meaningful clustering, with L: 0-100, a and b: -127 to 127
+    # scaled to similar importance and color weighted more than luminance
+    pixels_normalized = pixel_features(img_array)
     
     # Store RGB pixels for later color assignment
-    rgb_pixels = img_array.reshape(-1, c)
-    
-    # Normalize pixel values - very important for LAB space
-    # L: 0-100, a: -127 to 127, b: -127 to 127
-    # We'll scale them to have similar importance
-    pixels_normalized = pixels.astype(float)
-    # Weight channels differently: L channel usually less important than a,b for segmentation
-    weights = np.array([1.0, 2.0, 2.0])  # Give more weight to color than luminance
-    scale = np.array([100.0, 127.0, 127.0])  # LAB value ranges
-    pixels_normalized = (pixels_normalized / scale) * weights
+    rgb_pixels = img_array.reshape(-1, img_array.shape[2])
     
     if progress_callback:
         progress_callback(10)
@@ -358,156 +777,65 @@ def agglomerative_clustering_scratch(image, n_clusters=4, progress_callback=None
     n = len(pixels_normalized)
     
     # For very large images, sample a subset of pixels for clustering
-    max_samples = 2000  # Increased for better representation
+    max_samples = 20000  # the nearest-neighbour chain keeps memory O(n), so far more pixels fit the same time
     if n > max_samples:
         indices = np.random.choice(n, max_samples, replace=False)
         sampled_pixels = pixels_normalized[indices]
         is_sampled = True
     else:
         sampled_pixels = pixels_normalized
-        indices = np.arange(n)
         is_sampled = False
     
-    # Initialize clusters
-    num_points = len(sampled_pixels)
-    cluster_sizes = np.ones(num_points, dtype=int)
-    cluster_centroids = sampled_pixels.copy()
-    active_clusters = set(range(num_points))
-    cluster_mapping = [{i} for i in range(num_points)]
-    
-    # Pre-compute initial distances
-    distance_heap = calculate_initial_distances(sampled_pixels)
-    valid_pairs = set((i, j) for _, i, j in distance_heap if i < j)
-    
-    # Continue until we reach the desired number of clusters
-    current_clusters = num_points
-    while current_clusters > n_clusters:
-        if progress_callback:
-            progress_percent = 10 + 80 * (1 - (current_clusters - n_clusters) / (num_points - n_clusters))
-            progress_callback(min(90, progress_percent))
-        
-        # Find the closest pair of clusters
-        while True:
-            if not distance_heap:
-                break
-            
-            dist, i, j = heapq.heappop(distance_heap)
-            
-            if i not in active_clusters or j not in active_clusters:
-                continue
-                
-            if (i, j) not in valid_pairs:
-                continue
-                
-            # Valid merge found
-            break
-        
-        # Remove the pair from valid pairs
-        valid_pairs.remove((i, j))
-        
-        # Get sizes and centroids for merging
-        size_i = cluster_sizes[i]
-        size_j = cluster_sizes[j]
-        centroid_i = cluster_centroids[i]
-        centroid_j = cluster_centroids[j]
-        
-        # Calculate the new centroid (weighted average)
-        new_size = size_i + size_j
-        new_centroid = (size_i * centroid_i + size_j * centroid_j) / new_size
-        
-        # Update the first cluster
-        cluster_sizes[i] = new_size
-        cluster_centroids[i] = new_centroid
-        cluster_mapping[i].update(cluster_mapping[j])
-        
-        # Mark the second cluster as inactive
-        active_clusters.remove(j)
-        
-        # Calculate new distances
-        for k in active_clusters:
-            if k != i:
-                dist = ward_linkage_distance_optimized(
-                    cluster_sizes[i], cluster_sizes[k],
-                    cluster_centroids[i], cluster_centroids[k]
-                )
-                heapq.heappush(distance_heap, (dist, min(i, k), max(i, k)))
-                valid_pairs.add((min(i, k), max(i, k)))
-        
-        current_clusters -= 1
-    
-    if progress_callback:
-        progress_callback(90)
-    
-    # Create final clusters
-    final_clusters = [cluster_mapping[i] for i in active_clusters]
-    final_centroids = [cluster_centroids[i] for i in active_clusters]
-    
-    # Create a mapping from data points to cluster labels
-    cluster_labels = np.zeros(len(sampled_pixels), dtype=int)
-    for i, cluster in enumerate(final_clusters):
-        for idx in cluster:
-            cluster_labels[idx] = i
-    
-    # Map results back to original image size
-    if is_sampled:
-        # Assign each pixel to the nearest centroid
-        full_labels = np.zeros(n, dtype=int)
-        
-        batch_size = 20000
-        for i in range(0, n, batch_size):
-            batch_end = min(i + batch_size, n)
-            batch = pixels_normalized[i:batch_end]
-            
-            # Calculate distance to each centroid
-            distances = np.zeros((batch.shape[0], n_clusters))
-            for j in range(n_clusters):
-                diff = batch - final_centroids[j]
-                distances[:, j] = np.sum(diff * diff, axis=1)
-            
-            # Assign to closest centroid
-            full_labels[i:batch_end] = np.argmin(distances, axis=1)
-    else:
-        # For non-sampled data, use existing labels
-        full_labels = cluster_labels
-    
-    # Create segmented image with realistic colors
-    segmented = np.zeros_like(rgb_pixels)
-    
-    # For each cluster, compute the mean color from the original RGB values
-    for i in range(n_clusters):
-        mask = full_labels == i
-        if np.any(mask):
-            # Use the mean of original RGB values for this segment
-            mean_color = np.mean(rgb_pixels[mask], axis=0)
-            segmented[mask] = mean_color.astype(np.uint8)
-    
-    # Reshape back to image dimensions
-    segmented_img = segmented.reshape(h, w, c)
-    
-    # Resize back to original size with better interpolation
-    if small_img.size != image.size:
-        segmented_pil = Image.fromarray(segmented_img)
-        segmented_pil = segmented_pil.resize(image.size, Image.BICUBIC)
-        segmented_img = np.array(segmented_pil)
-    
-    # Apply more gentle post-processing for better visuals
-    # First, apply bilateral filter to smooth while preserving edges
-    segmented_img = cv2.bilateralFilter(segmented_img, 9, 75, 75)
-    
-    # Then apply a more subtle edge-preserving filter
-    segmented_img = cv2.edgePreservingFilter(segmented_img, flags=1, sigma_s=45, sigma_r=0.3)
+    # Build the Ward merges with the nearest-neighbour chain, all the way to a single cluster
+    merges = nn_chain_ward(sampled_pixels, progress_callback)
+    # the chain finds the merges out of order; sorted by cost they are the greedy merge order
+    merges = merges[np.argsort(merges[:, 2], kind='stable')]
     
-    if progress_callback:
-        progress_callback(100)
-    
-    elapsed_time = time.time() - start_time
-    print(f"Clustering completed in {elapsed_time:.2f} seconds")
-    
-    return segmented_img
+    prepared = {'small_size': small_img.size, 'pixels_normalized': pixels_normalized, 'rgb_pixels': rgb_pixels,
+                'sampled_pixels': sampled_pixels, 'is_sampled': is_sampled}
+    return Dendrogram(merges, len(sampled_pixels)), prepared
+
+class Dendrogram:
+    """Complete merge tree of number_of_points points (merges in merge order), cut at any number of clusters in O(n)"""
+    def __init__(self, merges, number_of_points):
+        self.merges = merges
+        self.number_of_points = number_of_points
+
+    def cut(self, n_clusters):
+        return cut_merges(self.merges, self.number_of_points, n_clusters)
 
-def agglomerative_clustering_builtin(image, n_clusters=4, progress_callback=None):
+# Merge trees of the last few images and feature settings, most recently used last
+DENDROGRAM_CACHE_SIZE = 4
+dendrogram_cache = OrderedDict()
+
+def cached_dendrogram(key, build):
+    if key in dendrogram_cache:
+        dendrogram_cache.move_to_end(key)
+        return dendrogram_cache[key]
+    dendrogram_cache[key] = build()
+    while len(dendrogram_cache) > DENDROGRAM_CACHE_SIZE:
+        dendrogram_cache.popitem(last=False)
+    return dendrogram_cache[key]
+
+def dendrogram_key(img_key, connectivity=None):
+    # Cache key of an image's merge tree: connectivity-constrained (4 or 8) or the sampled scratch tree (None)
+    if connectivity is None:
+        return ('scratch', img_key)
+    return ('connectivity', connectivity, img_key)
+
+def has_cached_dendrogram(img_key, connectivity=None):
+    return dendrogram_key(img_key, connectivity) in dendrogram_cache
+
+def image_key(img_array):
+    # Identifies the pixels of an image without copying them
+    return img_array.shape, hashlib.blake2b(np.ascontiguousarray(img_array).data).hexdigest()
+
+def agglomerative_clustering_builtin(image, n_clusters=4, progress_callback=None, enhanced_output=True, upsampling='bicubic'):
     """Use scikit-learn's built-in agglomerative clustering with improved visualization"""
     start_time = time.time()
+    original_img_array = np.asarray(image)
+    if isinstance(image, np.ndarray):
+        image = Image.fromarray(image)
     
     if progress_callback:
         progress_callback(10)
@@ -544,28 +872,8 @@ def agglomerative_clustering_builtin(image, n_clusters=4, progress_callback=None
     if progress_callback:
         progress_callback(70)
     
-    # Create segmented image with realistic colors
-    segmented = np.zeros_like(rgb_pixels)
-    
-    # For each cluster, compute the mean color from original RGB values
-    for i in range(n_clusters):
-        mask = cluster_labels == i
-        if np.any(mask):
-            mean_color = np.mean(rgb_pixels[mask], axis=0)
-            segmented[mask] = mean_color.astype(np.uint8)
-    
-    # Reshape back to image dimensions
-    segmented_img = segmented.reshape(h, w, c)
-    
-    # Resize back to original size with better interpolation
-    if small_img.size != image.size:
-        segmented_pil = Image.fromarray(segmented_img)
-        segmented_pil = segmented_pil.resize(image.size, Image.BICUBIC)
-        segmented_img = np.array(segmented_pil)
-    
-    # Post-processing for enhanced output - more gentle settings
-    segmented_img = cv2.bilateralFilter(segmented_img, 9, 75, 75)
-    segmented_img = cv2.edgePreservingFilter(segmented_img, flags=1, sigma_s=45, sigma_r=0.3)
+    # Segments painted with the mean of the original RGB values, at the original size
+    segmented_img = restore_resolution(original_img_array, img_array, cluster_labels, upsampling, enhanced_output)
     
     if progress_callback:
         progress_callback(100)
@@ -0,0 +1,21 @@
+import numpy as np
+
+
+class IntensityIndex:
+    """
+    Pixel positions grouped by gray level (a counting sort of the image): the flat indices of the
+    pixels of level v are order[offsets[v]:offsets[v+1]], in raster order. Built once per image,
+    finding a pixel of a given level then needs no scan of the whole image
+    """
+    def __init__(self, image):
+        self.shape = image.shape
+        # numpy's stable sort of 8-bit keys is a radix sort, so this is O(pixels); it already returns int64 indices
+        self.order = np.argsort(image.ravel(), kind='stable')
+        self.histogram = np.bincount(image.ravel(), minlength=256)
+        self.offsets = np.concatenate(([0], np.cumsum(self.histogram)))
+
+    def first_position(self, level):
+        # The first (y, x) of a gray level in raster order, or None when the level is absent
+        if self.histogram[level] == 0:
+            return None
+        return np.unravel_index(self.order[self.offsets[level]], self.shape)
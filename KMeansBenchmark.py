@@ -0,0 +1,81 @@
+import os
+import sys
+import time
+import cv2
+import numpy as np
+import KMeansClustering as km
+
+# (algorithm, coreset) pairs timed against the original norm-based loop on every image
+VARIANTS = [('full', None), ('hamerly', None), ('mini-batch', None), ('full', 'unique'), ('hamerly', 'unique')]
+
+
+def baseline_k_means(image, number_of_clusters=3):
+    """
+    The original k-means loop (random centers, np.linalg.norm over all pixels and centers at once,
+    masked means), kept as the reference the variants are measured against
+    """
+    pixel_values = np.float32(image.reshape((-1, 3)))
+    np.random.seed(42)
+    points = np.random.choice(pixel_values.shape[0], number_of_clusters, replace=False)
+    centers = np.array([pixel_values[idx] for idx in points])
+
+    for i in range(100):
+        distances = np.linalg.norm(pixel_values[:, np.newaxis] - centers, axis=2)
+        labels = np.argmin(distances, axis=1)
+
+        new_centers = []
+        for j in range(centers.shape[0]):
+            cluster_points = pixel_values[labels == j]
+            if cluster_points.size == 0:
+                new_centers.append(centers[j])
+            else:
+                new_centers.append(cluster_points.mean(axis=0))
+        new_centers = np.array(new_centers)
+
+        if np.allclose(centers, new_centers, atol=1e-2):
+            break
+        centers = new_centers
+
+    centers = np.uint8(centers)
+    return centers[labels.flatten()].reshape(image.shape)
+
+def benchmark(images_directory="Images", cluster_counts=(3, 8)):
+    """
+    Times the original loop and every k-means variant on each image of images_directory and reports
+    the speedup over the original, the mean squared distance of the pixels to their segment color,
+    and the fraction of pixels whose segment color differs from the original result
+    """
+    # compile the numba kernels before timing
+    warm_up = np.arange(48, dtype=np.uint8).reshape(4, 4, 3)
+    for algorithm, coreset in VARIANTS:
+        km.k_means_clustering(warm_up, False, number_of_clusters=3, algorithm=algorithm, coreset=coreset)
+
+    print(f"{'image':<16}{'K':>3}  {'variant':<18}{'seconds':>9}{'speedup':>9}{'inertia':>10}{'changed':>9}")
+    for file_name in sorted(os.listdir(images_directory)):
+        bgr_image = cv2.imread(os.path.join(images_directory, file_name), cv2.IMREAD_COLOR)
+        if bgr_image is None:
+            continue
+        rgb_image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
+
+        for number_of_clusters in cluster_counts:
+            start = time.perf_counter()
+            reference = baseline_k_means(rgb_image, number_of_clusters)
+            reference_time = time.perf_counter() - start
+            report(file_name, number_of_clusters, 'baseline', rgb_image, reference, reference_time, reference, reference_time)
+
+            for algorithm, coreset in VARIANTS:
+                start = time.perf_counter()
+                segmented_image = km.k_means_clustering(rgb_image, False, number_of_clusters=number_of_clusters,
+                                                        algorithm=algorithm, coreset=coreset)
+                elapsed = time.perf_counter() - start
+                variant = algorithm if coreset is None else f"{algorithm}+{coreset}"
+                report(file_name, number_of_clusters, variant, rgb_image, segmented_image, elapsed, reference, reference_time)
+
+def report(file_name, number_of_clusters, variant, rgb_image, segmented_image, elapsed, reference, reference_time):
+    inertia = ((rgb_image.astype(np.float64) - segmented_image) ** 2).sum(axis=2).mean()
+    changed = (segmented_image != reference).any(axis=2).mean()
+    print(f"{file_name:<16}{number_of_clusters:>3}  {variant:<18}{elapsed:>9.3f}{reference_time / elapsed:>8.1f}x"
+          f"{inertia:>10.1f}{changed:>9.4f}")
+
+if __name__ == "__main__":
+    benchmark(*sys.argv[1:2])
@@ -1,58 +1,424 @@
+import os
 import numpy as np
+from numba import jit, prange, get_num_threads
+import RestartExecutor as rex
+
+# Bytes of temporaries allowed for one chunk of the assignment pass
+DEFAULT_MEMORY_BUDGET = 64 * 2**20
+KMEANS_ALGORITHMS = ('full', 'mini-batch', 'hamerly')
+COLOR_CORESETS = (None, 'unique', 'grid')
+KMEANS_INITIALIZATIONS = ('random', 'k-means++')
 
 #variable to select between random or manual
 
 #طبعا انت هتغير الشرط بتاع if ان المستخدم لو اختار random او manual
 #في ال UI
-def k_means_clustering(image, manual_selection = True, points = None, number_of_clusters=3):
+def k_means_clustering(image, manual_selection = True, points = None, number_of_clusters=3, algorithm='full',
+                       memory_budget=DEFAULT_MEMORY_BUDGET, batch_size=4096, coreset=None, initialization='random',
+                       restarts=1, workers=None):
+    """
+    Without manual points, restarts runs start from different initial centers (k-means++ or random
+    pixels) and the result with the lowest inertia is kept; workers > 1 (or None for one per core)
+    runs them on a process pool
+    """
+    if algorithm not in KMEANS_ALGORITHMS:
+        raise ValueError("Invalid algorithm. Choose 'full', 'mini-batch' or 'hamerly'.")
+    if coreset not in COLOR_CORESETS:
+        raise ValueError("Invalid coreset. Choose None, 'unique' or 'grid'.")
+    if initialization not in KMEANS_INITIALIZATIONS:
+        raise ValueError("Invalid initialization. Choose 'random' or 'k-means++'.")
 
-    # reshape the image as a 2-D array
+    # reshape the image as a 2-D array, a view of the image: the pixels are converted chunk by chunk
     pixel_values = image.reshape((-1, 3))
 
-    pixel_values = np.float32(pixel_values)
-
-    if manual_selection == False:   #choosing randomly
+    if manual_selection == False and initialization == 'random' and restarts == 1:   #choosing randomly
         points = []
         np.random.seed(42)  # للتكرار نفس النتائج
         points = np.random.choice(pixel_values.shape[0], number_of_clusters, replace=False)
-        centers = np.array([pixel_values[idx] for idx in points])
+        centers = np.array([pixel_values[idx] for idx in points], dtype=np.float32)
+
+    elif manual_selection == False:
+        centers = None  # chosen per restart, on the coreset when there is one
 
     else:       #choosing maually
-        centers = np.array([pixel_values[y * image.shape[1] + x] for x, y in points])
+        centers = np.array([pixel_values[y * image.shape[1] + x] for x, y in points], dtype=np.float32)
+
 
+    # cluster the distinct colors weighted by their pixel counts instead of the pixels themselves
+    weights = None
+    if coreset is not None:
+        image_pixel_values = pixel_values
+        pixel_values, weights, inverse = color_coreset(image_pixel_values, coreset)
+
+    labels = np.empty(pixel_values.shape[0], dtype=np.int32)
+    if centers is not None:
+        centers = fit_centers(pixel_values, weights, centers, labels, algorithm, memory_budget, batch_size)
+    else:
+        seeds = [42 + restart for restart in range(restarts)]
+        if (workers or os.cpu_count()) == 1 or restarts == 1:
+            results = [fit_restart(pixel_values, weights, number_of_clusters, initialization, seed, algorithm, memory_budget,
+                                   batch_size) for seed in seeds]
+        else:
+            results = rex.parallel_restarts(fit_restart, pixel_values, weights, number_of_clusters, initialization, seeds,
+                                            algorithm, memory_budget, batch_size, workers)
+        inertia, centers = min(results, key=lambda result: result[0])
+        # one more pass labels the points with the winning centers
+        fused_assign_update(pixel_values, centers, labels, weights)
+
+    if coreset is not None:
+        labels = labels[inverse]
+
+    # visualize the clusters
+    centers = np.uint8(centers)
+    segmented_image = centers[labels]
+    segmented_image = segmented_image.reshape(image.shape)
+    return segmented_image
+
+def fit_centers(pixel_values, weights, centers, labels, algorithm='full', memory_budget=DEFAULT_MEMORY_BUDGET, batch_size=4096):
+    # Runs k-means from the given centers, labels holds the final assignment of every point
 
     # set the number of iterations
     max_iterations = 100
 
+    if algorithm == 'mini-batch':
+        centers = mini_batch_centers(pixel_values, centers, max_iterations, batch_size, weights=weights)
+        # a single full pass labels every pixel with the final centers
+        assign_labels(pixel_values, centers, labels, memory_budget)
+
+    elif algorithm == 'hamerly':
+        has_weights = weights is not None
+        weights = np.asarray(weights, dtype=np.float64) if has_weights else np.ones(1)
+        centers = hamerly_kmeans(pixel_values, weights, has_weights, centers.astype(np.float64), labels, max_iterations)
+
+    else:
+        for i in range(max_iterations):
+            # get the closest center of each point, and the sums and sizes of the clusters on the way
+            sums, counts = fused_assign_update(pixel_values, centers, labels, weights)
+
+            #calc new centers
+            new_centers = update_centers(centers, sums, counts)
+
+            # test the centers and new centers
+            if np.allclose(centers, new_centers, atol=1e-2):
+                break
+
+            centers = new_centers
+
+    return centers
+
+def fit_restart(pixel_values, weights, number_of_clusters, initialization, seed, algorithm='full',
+                memory_budget=DEFAULT_MEMORY_BUDGET, batch_size=4096):
+    # One restart: (inertia, centers) of a run from freshly chosen initial centers
+    rng = np.random.default_rng(seed)
+    if initialization == 'k-means++':
+        centers = k_means_plus_plus(pixel_values, weights, number_of_clusters, rng)
+    else:
+        probabilities = None if weights is None else weights / weights.sum()
+        distinct = min(number_of_clusters, pixel_values.shape[0])
+        chosen = rng.choice(pixel_values.shape[0], distinct, replace=False, p=probabilities)
+        if distinct < number_of_clusters:  # fewer distinct points than clusters: repeat some, as k_means_plus_plus does
+            chosen = np.concatenate((chosen, rng.choice(chosen, number_of_clusters - distinct)))
+        centers = pixel_values[chosen].astype(np.float32)
+
+    labels = np.empty(pixel_values.shape[0], dtype=np.int32)
+    centers = fit_centers(pixel_values, weights, centers, labels, algorithm, memory_budget, batch_size)
+    has_weights = weights is not None
+    inertia = clustering_inertia(pixel_values, centers, labels, np.asarray(weights, dtype=np.float64) if has_weights
+                                 else np.ones(1), has_weights)
+    return inertia, centers
+
+def k_means_plus_plus(pixel_values, weights, number_of_clusters, rng):
+    """
+    k-means++ seeding: the first center is a random point, every next one is drawn with probability
+    proportional to the squared distance to the closest center chosen so far (times the weight)
+    """
+    sampling_weights = np.ones(pixel_values.shape[0]) if weights is None else np.asarray(weights, dtype=np.float64)
+    closest_distances = np.full(pixel_values.shape[0], np.inf)
+    centers = np.empty((number_of_clusters, pixel_values.shape[1]), dtype=np.float32)
+
+    cumulative = np.cumsum(sampling_weights)
+    chosen = np.searchsorted(cumulative, rng.random() * cumulative[-1], side='right')
+    for j in range(number_of_clusters):
+        centers[j] = pixel_values[min(chosen, pixel_values.shape[0] - 1)]
+        if j == number_of_clusters - 1:
+            break
+        update_closest_distances(pixel_values, centers[j], closest_distances)
+        cumulative = np.cumsum(sampling_weights * closest_distances)
+        if cumulative[-1] <= 0:  # fewer distinct points than clusters
+            chosen = rng.integers(pixel_values.shape[0])
+        else:
+            chosen = np.searchsorted(cumulative, rng.random() * cumulative[-1], side='right')
+
+    return centers
+
+@jit(nopython=True, parallel=True, cache=True)
+def update_closest_distances(points, center, closest_distances):
+    for i in prange(points.shape[0]):
+        distance = 0.0
+        for d in range(points.shape[1]):
+            difference = np.float64(points[i, d]) - center[d]
+            distance += difference * difference
+        closest_distances[i] = min(closest_distances[i], distance)
+
+@jit(nopython=True, cache=True)
+def clustering_inertia(points, centers, labels, weights, has_weights):
+    # Sum of the (weighted) squared distances of the points to their centers
+    inertia = 0.0
+    for i in range(points.shape[0]):
+        distance = 0.0
+        for d in range(points.shape[1]):
+            difference = np.float64(points[i, d]) - centers[labels[i], d]
+            distance += difference * difference
+        inertia += distance * (weights[i] if has_weights else 1.0)
+    return inertia
+
+def color_coreset(pixel_values, coreset='unique'):
+    """
+    Reduces the pixels to weighted colors: (colors (m, 3) float32, weights (m,), inverse (n,)) with
+    pixel i represented by colors[inverse[i]]. 'unique' keeps every distinct color exactly, 'grid'
+    merges colors into 5-bit-per-channel cells, each represented by the mean color of its pixels
+    """
+    pixel_values = pixel_values.astype(np.int32, copy=False)
+    if coreset == 'unique':
+        keys = (pixel_values[:, 0] << 16) | (pixel_values[:, 1] << 8) | pixel_values[:, 2]
+        unique_keys, inverse, weights = np.unique(keys, return_inverse=True, return_counts=True)
+        colors = np.column_stack(((unique_keys >> 16) & 255, (unique_keys >> 8) & 255, unique_keys & 255)).astype(np.float32)
+        return colors, weights, inverse.ravel()
+
+    keys = ((pixel_values[:, 0] >> 3) << 10) | ((pixel_values[:, 1] >> 3) << 5) | (pixel_values[:, 2] >> 3)
+    cell_counts = np.bincount(keys, minlength=2**15)
+    occupied = np.flatnonzero(cell_counts)
+    cell_index = np.zeros(2**15, dtype=np.int64)
+    cell_index[occupied] = np.arange(len(occupied))
+
+    colors = np.empty((len(occupied), 3), dtype=np.float32)
+    for channel in range(3):
+        colors[:, channel] = np.bincount(keys, weights=pixel_values[:, channel], minlength=2**15)[occupied] / cell_counts[occupied]
+    return colors, cell_counts[occupied], cell_index[keys]
+
+def assign_labels(pixel_values, centers, labels, memory_budget=DEFAULT_MEMORY_BUDGET, weights=None):
+    """
+    Writes the nearest center of every pixel into labels and returns the per-cluster sums and counts.
+    Distances use ||x||^2 - 2 x.c + ||c||^2 in float32, one chunk of pixels at a time, so peak memory
+    is O(chunk x K) whatever the image size. With weights every point counts weights[i] times
+    """
+    number_of_clusters = centers.shape[0]
+    centers = np.asarray(centers, dtype=np.float32)
+    centers_squared = (centers * centers).sum(axis=1)
+    chunk_size = max(1024, memory_budget // ((2 * number_of_clusters + 4) * 4 + 8))
+
+    sums = np.zeros((number_of_clusters, pixel_values.shape[1]), dtype=np.float64)
+    counts = np.zeros(number_of_clusters, dtype=np.int64 if weights is None else np.float64)
+    for start in range(0, pixel_values.shape[0], chunk_size):
+        chunk = pixel_values[start:start + chunk_size].astype(np.float32)
+        # ||x||^2 is the same for every center, so it does not change the argmin
+        distances = chunk @ centers.T
+        distances *= -2
+        distances += centers_squared
+        chunk_labels = np.argmin(distances, axis=1)
+        labels[start:start + chunk_size] = chunk_labels
+
+        if weights is None:
+            counts += np.bincount(chunk_labels, minlength=number_of_clusters)
+            for channel in range(pixel_values.shape[1]):
+                sums[:, channel] += np.bincount(chunk_labels, weights=chunk[:, channel], minlength=number_of_clusters)
+        else:
+            chunk_weights = weights[start:start + chunk_size]
+            counts += np.bincount(chunk_labels, weights=chunk_weights, minlength=number_of_clusters)
+            for channel in range(pixel_values.shape[1]):
+                sums[:, channel] += np.bincount(chunk_labels, weights=chunk[:, channel] * chunk_weights,
+                                                minlength=number_of_clusters)
+
+    return sums, counts
+
+def fused_assign_update(pixel_values, centers, labels, weights=None):
+    # assign_labels in a single compiled pass over the pixels, spread over all cores
+    has_weights = weights is not None
+    weights = np.asarray(weights, dtype=np.float64) if has_weights else np.ones(1)
+    number_of_chunks = min(4 * get_num_threads(), max(1, pixel_values.shape[0]))
+    return assign_and_accumulate(pixel_values, np.asarray(centers, dtype=np.float32), labels, weights, has_weights,
+                                 number_of_chunks)
+
+@jit(nopython=True, parallel=True, cache=True)
+def assign_and_accumulate(points, centers, labels, weights, has_weights, number_of_chunks):
+    """
+    Labels every point with its nearest center and accumulates the cluster sums and counts in the
+    same pass. Each chunk of points has its own accumulators, summed at the end, so the threads
+    never write to shared memory and no temporary grows with the number of points
+    """
+    number_of_points, dimensions = points.shape
+    number_of_clusters = centers.shape[0]
+    chunk_size = (number_of_points + number_of_chunks - 1) // number_of_chunks
+    chunk_sums = np.zeros((number_of_chunks, number_of_clusters, dimensions), dtype=np.float64)
+    chunk_counts = np.zeros((number_of_chunks, number_of_clusters), dtype=np.float64)
+
+    for chunk in prange(number_of_chunks):
+        for i in range(chunk * chunk_size, min(number_of_points, (chunk + 1) * chunk_size)):
+            closest = 0
+            closest_distance = np.inf
+            for j in range(number_of_clusters):
+                distance = 0.0
+                for d in range(dimensions):
+                    difference = np.float64(points[i, d]) - centers[j, d]
+                    distance += difference * difference
+                if distance < closest_distance:
+                    closest_distance = distance
+                    closest = j
+            labels[i] = closest
+
+            weight = weights[i] if has_weights else 1.0
+            chunk_counts[chunk, closest] += weight
+            for d in range(dimensions):
+                chunk_sums[chunk, closest, d] += weight * points[i, d]
+
+    return chunk_sums.sum(axis=0), chunk_counts.sum(axis=0)
+
+def mini_batch_centers(pixel_values, centers, max_iterations=100, batch_size=4096, seed=42, weights=None, seen_counts=None):
+    """
+    Mini-batch k-means (Sculley): every iteration assigns a random batch of pixels and moves each
+    center towards the mean of its batch pixels with a learning rate of 1 / (pixels it has seen so
+    far), so the cost of an iteration does not depend on the image size. Weighted points are drawn
+    in proportion to their weights. Passing seen_counts (updated in place) carries the learning
+    rates over from earlier calls, to keep fitting the same centers on more data
+    """
+    rng = np.random.default_rng(seed)
+    centers = np.array(centers, dtype=np.float32)
+    if seen_counts is None:
+        seen_counts = np.zeros(centers.shape[0], dtype=np.int64)
+    batch_labels = np.empty(batch_size, dtype=np.int32)
+    probabilities = None if weights is None else weights / weights.sum()
+
     for i in range(max_iterations):
-        # calc the distance between each point and center
-        distances = np.linalg.norm(pixel_values[:, np.newaxis] - centers, axis=2)
-
-        # get the closest points to each center
-        labels = np.argmin(distances, axis=1)
-
-        #calc new centers
-        # new_centers = np.array([pixel_values[labels == j].mean(axis=0) for j in range(len(points))])
-        new_centers = []
-        
-        for j in range(centers.shape[0]):
-            cluster_points = pixel_values[labels == j]
-            if cluster_points.size == 0:
-                # Handle empty cluster: keep old center
-                new_centers.append(centers[j])
-            else:
-                new_centers.append(cluster_points.mean(axis=0))
-        new_centers = np.array(new_centers)
+        if probabilities is None:
+            batch = pixel_values[rng.integers(0, pixel_values.shape[0], size=batch_size)]
+        else:
+            batch = pixel_values[rng.choice(pixel_values.shape[0], size=batch_size, p=probabilities)]
+        sums, counts = assign_labels(batch, centers, batch_labels)
 
+        seen_counts += counts
+        filled = counts > 0
+        new_centers = centers.copy()
+        new_centers[filled] += (sums[filled] - counts[filled, np.newaxis] * centers[filled]) / seen_counts[filled, np.newaxis]
 
-        # test the centers and new centers
         if np.allclose(centers, new_centers, atol=1e-2):
             break
-
         centers = new_centers
 
-    # visualize the clusters
-    centers = np.uint8(centers)
-    segmented_image = centers[labels.flatten()]
-    segmented_image = segmented_image.reshape(image.shape)
-    return segmented_image
+    return centers
+
+def update_centers(centers, sums, counts):
+    # Handle empty cluster: keep old center
+    new_centers = np.array(centers, dtype=np.float32)
+    filled = counts > 0
+    new_centers[filled] = sums[filled] / counts[filled, np.newaxis]
+    return new_centers
+
+@jit(nopython=True, cache=True)
+def hamerly_kmeans(points, weights, has_weights, centers, labels, max_iterations=100, tolerance=1e-2):
+    """
+    Lloyd iterations with Hamerly's bounds: every point keeps an upper bound on the distance to its
+    own center and a lower bound on the distance to any other one. Both are moved by how far the
+    centers moved, and the distances of a point are only recomputed when the bounds can no longer
+    prove its label is unchanged, which after the first iterations is true for few points.
+    Cluster sums are updated only for the points that change cluster. Stops like the full batch
+    loop, and returns the centers the final labels were assigned with
+    """
+    number_of_points, dimensions = points.shape
+    number_of_clusters = centers.shape[0]
+    upper_bounds = np.empty(number_of_points, dtype=np.float32)
+    lower_bounds = np.empty(number_of_points, dtype=np.float32)
+    sums = np.zeros((number_of_clusters, dimensions), dtype=np.float64)
+    counts = np.zeros(number_of_clusters, dtype=np.float64)
+
+    for i in range(number_of_points):
+        closest, second_distance, closest_distance = nearest_two_centers(points[i], centers)
+        labels[i] = closest
+        upper_bounds[i] = closest_distance
+        lower_bounds[i] = second_distance
+        weight = weights[i] if has_weights else 1.0
+        counts[closest] += weight
+        for d in range(dimensions):
+            sums[closest, d] += weight * points[i, d]
+
+    new_centers = centers.copy()
+    shifts = np.empty(number_of_clusters, dtype=np.float64)
+    half_separations = np.empty(number_of_clusters, dtype=np.float64)
+    for _ in range(max_iterations):
+        converged = True
+        for j in range(number_of_clusters):
+            shift = 0.0
+            for d in range(dimensions):
+                # Handle empty cluster: keep old center
+                new_centers[j, d] = sums[j, d] / counts[j] if counts[j] > 0 else centers[j, d]
+                difference = new_centers[j, d] - centers[j, d]
+                if abs(difference) > tolerance + 1e-5 * abs(new_centers[j, d]):  # np.allclose
+                    converged = False
+                shift += difference * difference
+            shifts[j] = np.sqrt(shift)
+        if converged:
+            break
+        centers[:] = new_centers
+
+        # the largest shift lowers the lower bounds, except for the points of that very center
+        largest = np.argmax(shifts)
+        second_largest_shift = 0.0
+        for j in range(number_of_clusters):
+            if j != largest and shifts[j] > second_largest_shift:
+                second_largest_shift = shifts[j]
+
+        # a point closer to its center than half the distance to the nearest other center stays put
+        for j in range(number_of_clusters):
+            half_separations[j] = np.inf
+            for other in range(number_of_clusters):
+                if other != j:
+                    distance = 0.0
+                    for d in range(dimensions):
+                        distance += (centers[j, d] - centers[other, d]) ** 2
+                    half_separations[j] = min(half_separations[j], 0.5 * np.sqrt(distance))
+
+        for i in range(number_of_points):
+            label = labels[i]
+            upper_bounds[i] += shifts[label]
+            lower_bounds[i] -= second_largest_shift if label == largest else shifts[largest]
+
+            bound = max(half_separations[label], lower_bounds[i])
+            if upper_bounds[i] <= bound:
+                continue
+            distance = 0.0
+            for d in range(dimensions):
+                distance += (points[i, d] - centers[label, d]) ** 2
+            upper_bounds[i] = np.sqrt(distance)
+            if upper_bounds[i] <= bound:
+                continue
+
+            closest, second_distance, closest_distance = nearest_two_centers(points[i], centers)
+            upper_bounds[i] = closest_distance
+            lower_bounds[i] = second_distance
+            if closest != label:
+                weight = weights[i] if has_weights else 1.0
+                counts[label] -= weight
+                counts[closest] += weight
+                for d in range(dimensions):
+                    sums[label, d] -= weight * points[i, d]
+                    sums[closest, d] += weight * points[i, d]
+                labels[i] = closest
+
+    return centers.astype(np.float32)
+
+@jit(nopython=True, cache=True)
+def nearest_two_centers(point, centers):
+    # (index of the closest center, distance to the second closest, distance to the closest)
+    closest = 0
+    closest_distance = np.inf
+    second_distance = np.inf
+    for j in range(centers.shape[0]):
+        distance = 0.0
+        for d in range(centers.shape[1]):
+            distance += (point[d] - centers[j, d]) ** 2
+        if distance < closest_distance:
+            second_distance = closest_distance
+            closest_distance = distance
+            closest = j
+        elif distance < second_distance:
+            second_distance = distance
+    return closest, np.sqrt(second_distance), np.sqrt(closest_distance)
@@ -1,19 +1,25 @@
 from PyQt5.QtWidgets import (QMainWindow, QApplication, QFileDialog)
 import sys
-from PyQt5 import QtGui
+from PyQt5 import QtGui, QtCore
 import cv2
 import numpy as np
-from PIL import Image
 import UI
 import RegionGrowing as rg
+import IntensityIndex as ii
 import OptimalThresholding as ot
 import OtsuThresholding as otsu
 import SpectralThresholding as st
+import SlidingWindowThresholding as swt
+import ThresholdLUT as lt
+import TileExecutor as te
 import shift_mean_segmentation as ms
 import Agglomerative_Clustering as ac
 import KMeansClustering as km
 from qt_material import apply_stylesheet
 
+# Live mode renders at full resolution once the sliders have been still for this long
+LIVE_RENDER_DELAY_MS = 250
+
 
 class MainWindow(QMainWindow, UI.ImageSegmentationUI):
     def __init__(self):
@@ -26,12 +32,27 @@ class MainWindow(QMainWindow, UI.ImageSegmentationUI):
 
         self.segmentatioMethodComboBox.currentTextChanged.connect(self.resetPoints)
         self.thresholdingMethodComboBox.currentTextChanged.connect(self.resetPoints)
+        self.numberOfBlocksSlider.valueChanged.connect(self.UpdateLocalThresholding)
+        self.numberOfThresholdsSlider.valueChanged.connect(self.PreviewThresholding)
+        # Dragging, the keyboard, the wheel and page steps all change the value: the full resolution render
+        # follows any of them once the value settles
+        self.liveRenderTimer = QtCore.QTimer(self)
+        self.liveRenderTimer.setSingleShot(True)
+        self.liveRenderTimer.setInterval(LIVE_RENDER_DELAY_MS)
+        self.liveRenderTimer.timeout.connect(self.RenderLiveThresholding)
+        self.numberOfBlocksSlider.valueChanged.connect(self.ScheduleLiveRender)
+        self.numberOfThresholdsSlider.valueChanged.connect(self.ScheduleLiveRender)
+        self.thresholdingMethodComboBox.currentTextChanged.connect(self.UpdateLiveThresholdingAvailability)
+        self.localThresholdingCheckBox.stateChanged.connect(self.UpdateLiveThresholdingAvailability)
+        self.numberOfClustersSlider.sliderReleased.connect(self.RecutAgglomerativeClustering)
 
         self.grayscale_image = None
+        self.shared_grayscale = None
         self.processedImage = None
         self.points = []
         self.file_name = "Images/objects.png"
         self.LoadImage(self.file_name)
+        self.UpdateLiveThresholdingAvailability()
 
     def LoadImage(self, file_name=None):
         if file_name is None:
@@ -41,57 +62,175 @@ class MainWindow(QMainWindow, UI.ImageSegmentationUI):
             self.original_rgb_image = cv2.imread(file_name, cv2.IMREAD_COLOR_RGB)
             self.rgb_image_to_display = self.original_rgb_image.copy()
             self.grayscale_image = cv2.cvtColor(self.original_rgb_image.copy(), cv2.COLOR_RGB2GRAY)
-            self.histogram = np.histogram(self.grayscale_image.copy().flatten(), bins=256, range=[0, 256])[0]
+            self.intensity_index = ii.IntensityIndex(self.grayscale_image)
+            self.histogram = self.intensity_index.histogram
+            self.integral_histogram = otsu.block_integral_histogram(self.grayscale_image, self.numberOfBlocksSlider.maximum())
+            # Local thresholding of large images runs on a process pool reading this one shared copy
+            if self.shared_grayscale is not None:
+                self.shared_grayscale.close()
+            self.shared_grayscale = te.SharedImage(self.grayscale_image)
+            te.prepare_tile_pool(self.grayscale_image.size)
+            self.MakeDisplayProxy()
             self.resetPoints()
+            self.clustered_image_key = None
+            self.clustered_result = None
 
             self.DisplayImage(self.original_rgb_image, self.originalImageLabel)
 
     def ApplyThresholding(self, threshold_type):
         if self.grayscale_image is not None:
-            image = self.grayscale_image.copy()
-            if self.localThresholdingCheckBox.isChecked():
+            image = self.grayscale_image  # thresholding never writes into its input
+            numberOfThresholds = self.numberOfThresholdsSlider.value()
+            if self.localThresholdingCheckBox.isChecked() and self.slidingWindowCheckBox.isChecked():
+                windowSize = 2 * self.windowSizeSlider.value() + 1
+                self.processedImage = swt.sliding_window_thresholding(image, window_size=windowSize, thresholding_method=threshold_type,
+                                                                      number_of_thresholds=numberOfThresholds)
+
+            elif self.localThresholdingCheckBox.isChecked():
+                numberOfBlocks = self.numberOfBlocksSlider.value()
                 if threshold_type == "Otsu Thresholding":
-                    self.processedImage = otsu.local_thresholding(image, number_of_blocks=4, thresholding_method='Otsu Thresholding')
+                    self.processedImage = te.local_thresholding(self.shared_grayscale, number_of_blocks=numberOfBlocks, thresholding_method='Otsu Thresholding',
+                                                                   number_of_thresholds=numberOfThresholds, integral_histogram=self.integral_histogram)
 
                 elif threshold_type == "Optimal Thresholding":
-                    self.processedImage = otsu.local_thresholding(image, number_of_blocks=4, thresholding_method='Optimal Thresholding')
+                    self.processedImage = te.local_thresholding(self.shared_grayscale, number_of_blocks=numberOfBlocks, thresholding_method='Optimal Thresholding',
+                                                                   integral_histogram=self.integral_histogram)
 
                 elif threshold_type == "Spectral Thresholding":
-                    self.processedImage = otsu.local_thresholding(image, number_of_blocks=4,
-                                                                   thresholding_method='Spectral Thresholding', number_of_thresholds=2)
+                    self.processedImage = te.local_thresholding(self.shared_grayscale, number_of_blocks=numberOfBlocks, thresholding_method='Spectral Thresholding',
+                                                                   number_of_thresholds=numberOfThresholds, integral_histogram=self.integral_histogram)
 
             else:
                 if threshold_type == "Otsu Thresholding":
-                    self.processedImage = otsu.otsu_global_thresholding(image, self.histogram)
+                    self.processedImage = otsu.otsu_global_thresholding(image, self.histogram, number_of_thresholds=numberOfThresholds)
 
                 elif threshold_type == "Optimal Thresholding":
-                    self.processedImage = ot.OptimalThresholding(image)[0]
+                    self.processedImage = ot.OptimalThresholding(image, self.histogram)[0]
 
                 elif threshold_type == "Spectral Thresholding":
-                    self.processedImage = st.spectral_thresholding(image, self.histogram, number_of_thresholds=2)    
+                    self.processedImage = st.spectral_thresholding(image, self.histogram, number_of_thresholds=numberOfThresholds)    
 
             self.DisplayImage(self.processedImage, self.processedImageLabel)
 
+    def UpdateLocalThresholding(self):
+        # Re-tiling only queries the cached integral histogram, so the view can follow the blocks slider
+        if self.localThresholdingCheckBox.isChecked() and not self.slidingWindowCheckBox.isChecked():
+            if self.LiveThresholdingActive():
+                self.PreviewThresholding()
+            else:
+                self.ApplyThresholding(self.thresholdingMethodComboBox.currentText())
+
+    def MakeDisplayProxy(self):
+        # Grayscale copy at the resolution of the processed image label, used while a slider is dragged
+        height, width = self.grayscale_image.shape
+        scale = min(1.0, self.processedImageLabel.width() / width)
+        proxy_size = (max(1, round(width * scale)), max(1, round(height * scale)))
+        self.display_proxy = cv2.resize(self.grayscale_image, proxy_size, interpolation=cv2.INTER_AREA)
+        self.preview_buffer = np.empty_like(self.display_proxy)
+
+    def PreviewThresholding(self):
+        # Live mode: only the cached histograms are thresholded, and the lookup tables are applied to the display proxy
+        if self.grayscale_image is None or not self.LiveThresholdingActive():
+            return
+        if self.localThresholdingCheckBox.isChecked() and self.slidingWindowCheckBox.isChecked():
+            return  # per-pixel windows have no cached histograms, they are rendered on release
+
+        threshold_type = self.thresholdingMethodComboBox.currentText()
+        numberOfThresholds = self.numberOfThresholdsSlider.value()
+        if self.localThresholdingCheckBox.isChecked():
+            blocks, luts = otsu.local_block_luts(self.grayscale_image, self.numberOfBlocksSlider.value(), threshold_type,
+                                                 numberOfThresholds, self.integral_histogram)
+            scale_y = self.display_proxy.shape[0] / self.grayscale_image.shape[0]
+            scale_x = self.display_proxy.shape[1] / self.grayscale_image.shape[1]
+            for (y_start, y_end, x_start, x_end), lut in zip(blocks, luts):
+                y_start, y_end = round(y_start * scale_y), round(y_end * scale_y)
+                x_start, x_end = round(x_start * scale_x), round(x_end * scale_x)
+                lt.apply_lut(self.display_proxy[y_start:y_end, x_start:x_end], lut,
+                             out=self.preview_buffer[y_start:y_end, x_start:x_end])
+        else:
+            if threshold_type == "Otsu Thresholding":
+                thresholds = otsu.otsu_thresholds(self.histogram, numberOfThresholds)
+
+            elif threshold_type == "Spectral Thresholding":
+                thresholds = st.spectral_thresholds(self.histogram, numberOfThresholds)
+
+            lt.apply_thresholds(self.display_proxy, thresholds, out=self.preview_buffer)
+
+        self.DisplayImage(self.preview_buffer, self.processedImageLabel)
+
+    def ScheduleLiveRender(self):
+        # Every new value restarts the timer, so only the value the slider settles on is rendered
+        if self.LiveThresholdingActive():
+            self.liveRenderTimer.start()
+
+    def RenderLiveThresholding(self):
+        # The full resolution result is only computed once the slider has settled
+        if self.LiveThresholdingActive():
+            self.ApplyThresholding(self.thresholdingMethodComboBox.currentText())
+
+    def LiveThresholdingActive(self):
+        return self.liveThresholdingCheckBox.isChecked() and self.liveThresholdingCheckBox.isEnabled()
+
+    def UpdateLiveThresholdingAvailability(self):
+        # Global Optimal thresholding has no slider to follow, live mode is only offered where one is shown
+        available = self.localThresholdingCheckBox.isChecked() or self.thresholdingMethodComboBox.currentText() != "Optimal Thresholding"
+        self.liveThresholdingCheckBox.setEnabled(available)
+        self.liveThresholdingCheckBox.setToolTip("" if available else
+                                                 "Global Optimal Thresholding has no slider to preview, use Apply instead")
+
+    def RecutAgglomerativeClustering(self):
+        # Cutting the cached merge tree at another number of clusters takes milliseconds; without a tree for
+        # the result on screen (new image, another result shown, tree evicted) releasing the slider does nothing
+        if self.segmentatioMethodComboBox.currentText() != "Agglomerative Clustering" or self.clustered_image_key is None:
+            return
+        if self.processedImage is not self.clustered_result:
+            return
+        connectivity = 4 if self.connectivityCheckBox.isChecked() else None
+        if ac.has_cached_dendrogram(self.clustered_image_key, connectivity):
+            self.ApplySegmentation("Agglomerative Clustering")
+
     def ApplySegmentation(self, method):
         if self.grayscale_image is not None:
             if method == "Region Growing":
                 gray_image = self.grayscale_image.copy()
                 manualPointsSelection = self.manualPointSelectionCheckBox.isChecked()
                 threshold = self.regionGrowingThresholdSlider.value()
-                self.processedImage = rg.ApplyRegionGrowing(gray_image, self.histogram, threshold, manualPointsSelection, self.points)
+                if manualPointsSelection:
+                    self.processedImage = self.GrowSeededRegions(threshold).color_labels()
+                else:
+                    self.processedImage = rg.ApplyRegionGrowing(gray_image, self.histogram, threshold, manualPointsSelection, self.points,
+                                                                intensity_index=self.intensity_index)
                 
             elif method == "K-means Clustering":
-                rgb_image = self.original_rgb_image.copy()
+                rgb_image = self.original_rgb_image  # k-means only reads the pixels, chunk by chunk
                 numberOfClusters = self.numberOfClustersSlider.value()
                 manualPointsSelection = self.manualPointSelectionCheckBox.isChecked()
+                algorithm = {"Mini-batch": 'mini-batch', "Hamerly": 'hamerly'}.get(self.kMeansAlgorithmComboBox.currentText(), 'full')
                 self.processedImage = km.k_means_clustering(rgb_image, manual_selection = manualPointsSelection,
-                                                             points= self.points, number_of_clusters = numberOfClusters)
+                                                             points= self.points, number_of_clusters = numberOfClusters,
+                                                             algorithm = algorithm,
+                                                             # mini-batch already bounds the work per iteration, sorting out the
+                                                             # unique colors of every pixel would cost more than it saves
+                                                             coreset = None if algorithm == 'mini-batch' else 'unique',
+                                                             # one k-means++ run per click, restarts are for batch use
+                                                             initialization = 'k-means++')
 
             elif method == "Agglomerative Clustering":
                 numberOfClusters = self.numberOfClustersSlider.value()
-                rgb_image = Image.open(self.file_name).convert('RGB')
-                self.processedImage = ac.agglomerative_clustering_scratch(rgb_image, n_clusters=numberOfClusters, 
-                                                                          progress_callback= self.update_progress_bar)
+                if self.connectivityCheckBox.isChecked():
+                    # full resolution, only neighbouring regions merge
+                    self.processedImage = ac.agglomerative_clustering_connectivity(self.original_rgb_image, n_clusters=numberOfClusters,
+                                                                                   progress_callback= self.update_progress_bar)
+                else:
+                    # the merge tree of the loaded image is cached, so a new number of clusters only re-cuts it;
+                    # the label map is upsampled against the image, the smoothing filters are optional
+                    self.processedImage = ac.agglomerative_clustering_scratch(self.original_rgb_image, n_clusters=numberOfClusters, 
+                                                                              progress_callback= self.update_progress_bar,
+                                                                              enhanced_output= self.smoothSegmentsCheckBox.isChecked(),
+                                                                              upsampling= 'labels')
+                # the slider re-cuts this result while its merge tree is cached
+                self.clustered_image_key = ac.image_key(self.original_rgb_image)
+                self.clustered_result = self.processedImage
 
             elif method == "Mean Shift":
                 rgb_image = self.original_rgb_image.copy()
@@ -125,13 +264,48 @@ class MainWindow(QMainWindow, UI.ImageSegmentationUI):
     def getPoints(self, event):
             x = int(event.pos().x() * self.original_rgb_image.shape[1] / self.originalImageLabel.width())
             y = int(event.pos().y() * self.original_rgb_image.shape[0] / self.originalImageLabel.height())
-            self.points.append((x, y))
-            print(self.points)
-            cv2.circle(self.rgb_image_to_display, (x, y), 5, (0, 0, 255), -1)
+            x = min(max(x, 0), self.original_rgb_image.shape[1] - 1)
+            y = min(max(y, 0), self.original_rgb_image.shape[0] - 1)
+            growing = self.segmentatioMethodComboBox.currentText() == "Region Growing"
+
+            if growing and event.button() == QtCore.Qt.RightButton:
+                # Right click removes the region that was clicked, only that region is cleared
+                if self.region_growing is None:
+                    return
+                region_id = self.region_growing.labels[y, x]
+                if region_id == 0:
+                    return
+                # every click inside the region goes with it, a leftover one would grow it again
+                self.points = [(px, py) for px, py in self.points if self.region_growing.labels[py, px] != region_id]
+                self.region_growing.remove_region_at(x, y)
+                self.rgb_image_to_display = self.original_rgb_image.copy()
+                for point in self.points:
+                    cv2.circle(self.rgb_image_to_display, point, 5, (0, 0, 255), -1)
+            else:
+                self.points.append((x, y))
+                print(self.points)
+                cv2.circle(self.rgb_image_to_display, (x, y), 5, (0, 0, 255), -1)
             self.DisplayImage(self.rgb_image_to_display, self.originalImageLabel)
 
+            if growing:
+                # Only the clicked seed's region is grown, the rest of the label map is kept
+                self.processedImage = self.GrowSeededRegions(self.regionGrowingThresholdSlider.value()).color_labels()
+                self.DisplayImage(self.processedImage, self.processedImageLabel)
+
+    def GrowSeededRegions(self, threshold):
+        # The label map is rebuilt only when the threshold changed, otherwise just the new seeds are grown
+        if self.region_growing is None or self.region_growing.threshold != threshold:
+            self.region_growing = rg.IncrementalRegionGrowing(self.grayscale_image, threshold)
+        grown_points = set(self.region_growing.seeds.values())
+        for x, y in self.points:
+            if (x, y) not in grown_points:
+                self.region_growing.add_seed(x, y)
+                grown_points.add((x, y))
+        return self.region_growing
+
     def resetPoints(self):
         self.points = []
+        self.region_growing = None
         self.rgb_image_to_display = self.original_rgb_image.copy()
         self.DisplayImage(self.rgb_image_to_display, self.originalImageLabel)
 
@@ -147,6 +321,11 @@ class MainWindow(QMainWindow, UI.ImageSegmentationUI):
     def doNothing(self, event):
         pass
 
+    def closeEvent(self, event):
+        if self.shared_grayscale is not None:
+            self.shared_grayscale.close()
+        super().closeEvent(event)
+
 if __name__ == "__main__":
     app = QApplication(sys.argv)
     window = MainWindow()
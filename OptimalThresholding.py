@@ -1,51 +1,100 @@
 import numpy as np
+from numba import jit
+import ThresholdLUT as lt
 
 
-def OptimalThresholding(image):
+def OptimalThresholding(image, histogram=None, out=None):
+    if histogram is None:
+        histogram = np.bincount(image.ravel(), minlength=256)
+
+    new_threshold = optimal_threshold(image, histogram)
+    thresholded_image = apply_threshold(image, new_threshold, out)
+    return thresholded_image, new_threshold
+
+def optimal_threshold(image, histogram):
+    # Only the four corner pixels are read, the iterations run on the histogram
+    current_threshold = initial_threshold(image, histogram)
+    return int(calculate_new_threshold(np.asarray(histogram, dtype=np.int64), current_threshold))
+
+def initial_threshold(image, histogram):
+    # The four corners are taken as background, everything else as objects
     height, width = image.shape
+    corners = np.array([image[0, 0], image[0, width-1], image[height-1, 0], image[height-1, width-1]], dtype=np.int64)
+    return int(initial_thresholds_batch(corners[np.newaxis], np.asarray(histogram)[np.newaxis])[0])
 
-    background_pixels = []
-    background_pixels.append([image[0, 0], image[0, width-1], image[height-1, 0], image[height-1, width-1]])
-    background_pixels_array = np.array(background_pixels, dtype=np.uint8)
-    background_pixels_sum = background_pixels_array.sum()
-    meu_background = int(background_pixels_sum / 4.0)
+def initial_thresholds_batch(corners, histograms):
+    # corners: (n, 4) corner pixels of every block, histograms: (n, 256)
+    background_pixels_sum = corners.astype(np.int64).sum(axis=1)
+    meu_background = background_pixels_sum // 4
 
-    object_pixels_sum = image.sum() - background_pixels_sum
-    object_pixels_count = (height * width) - 4  
-    meu_objects = int(object_pixels_sum / object_pixels_count)
+    image_sum = histograms.astype(np.int64) @ np.arange(256, dtype=np.int64)
+    object_pixels_sum = image_sum - background_pixels_sum
+    object_pixels_count = np.maximum(histograms.sum(axis=1) - 4, 1)
+    meu_objects = object_pixels_sum // object_pixels_count
 
-    current_threshold = int((meu_background + meu_objects) / 2)
-    new_threshold = calculate_new_threshold(image, current_threshold, height, width)
-    thresholded_image = apply_threshold(image, new_threshold, height, width)
-    return thresholded_image, new_threshold
+    return (meu_background + meu_objects) // 2
+
+def optimal_thresholds_batch(histograms, initial_thresholds, max_iterations=256):
+    """
+    calculate_new_threshold for a stack of histograms (n, 256) at once: every iteration
+    is a handful of vectorized operations over all the histograms still moving
+    """
+    histograms = np.asarray(histograms, dtype=np.int64)
+    rows = np.arange(histograms.shape[0])
+    cumulative_count = np.concatenate((np.zeros((len(rows), 1), dtype=np.int64), np.cumsum(histograms, axis=1)), axis=1)
+    cumulative_sum = np.concatenate((np.zeros((len(rows), 1), dtype=np.int64),
+                                     np.cumsum(histograms * np.arange(256, dtype=np.int64), axis=1)), axis=1)
+    total_count = cumulative_count[:, -1]
+    total_sum = cumulative_sum[:, -1]
+
+    current_thresholds = np.asarray(initial_thresholds, dtype=np.int64).copy()
+    moving = np.ones(len(rows), dtype=bool)
+    for _ in range(max_iterations):
+        background_count = cumulative_count[rows, current_thresholds]
+        object_count = total_count - background_count
+        moving &= (background_count > 0) & (object_count > 0)
+
+        meu_background = cumulative_sum[rows, current_thresholds] // np.maximum(background_count, 1)
+        meu_objects = (total_sum - cumulative_sum[rows, current_thresholds]) // np.maximum(object_count, 1)
+        new_thresholds = (meu_background + meu_objects) // 2
+
+        moving &= new_thresholds != current_thresholds
+        if not moving.any():
+            break
+        current_thresholds[moving] = new_thresholds[moving]
+
+    return current_thresholds
+
+@jit(nopython=True, cache=True)
+def calculate_new_threshold(histogram, current_threshold, max_iterations=256):
+    """
+    Iterative selection on the histogram: class sizes and sums come from cumulative
+    tables, so every iteration is O(1) after an O(256) setup
+    """
+    cumulative_count = np.zeros(257, dtype=np.int64)
+    cumulative_sum = np.zeros(257, dtype=np.int64)
+    for level in range(256):
+        cumulative_count[level + 1] = cumulative_count[level] + histogram[level]
+        cumulative_sum[level + 1] = cumulative_sum[level] + level * histogram[level]
+    total_count = cumulative_count[256]
+    total_sum = cumulative_sum[256]
+
+    for _ in range(max_iterations):
+        # background is every gray level below the threshold
+        background_count = cumulative_count[current_threshold]
+        object_count = total_count - background_count
+        if background_count == 0 or object_count == 0:
+            return current_threshold
+
+        meu_background = cumulative_sum[current_threshold] // background_count
+        meu_objects = (total_sum - cumulative_sum[current_threshold]) // object_count
+
+        new_threshold = (meu_background + meu_objects) // 2
+        if new_threshold == current_threshold:
+            return new_threshold
+        current_threshold = new_threshold
+
+    return current_threshold
 
-def calculate_new_threshold(image, current_threshold, height, width):
-    background_pixels = []
-    object_pixels = []  
-    for i in range(0, height):
-        for j in range(0, width):
-            if image[i, j] < current_threshold:
-                background_pixels.append(image[i, j])
-            else:
-                object_pixels.append(image[i, j])
-    background_pixels_array = np.array(background_pixels, dtype=np.uint8)
-    meu_background = int(np.mean(background_pixels_array))
-
-    object_pixels_array = np.array(object_pixels, dtype=np.uint8)
-    meu_objects = int(np.mean(object_pixels_array))
-
-    new_threshold = int((meu_background + meu_objects) / 2)
-
-    if new_threshold == current_threshold:
-        return new_threshold
-    else:
-        return calculate_new_threshold(image, new_threshold, height, width)
-    
-def apply_threshold(image, new_threshold, height, width):
-    for i in range(0, height):
-        for j in range(0, width):
-            if image[i, j] < new_threshold:
-                image[i, j] = 0
-            else:
-                image[i, j] = 255
-    return image
+def apply_threshold(image, new_threshold, out=None):
+    return lt.apply_thresholds(image, [new_threshold], out)
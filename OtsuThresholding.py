@@ -1,79 +1,239 @@
 import numpy as np
+from numba import jit, prange
 import OptimalThresholding as ot
 import SpectralThresholding as st
-
-def otsu_global_thresholding(image, histogram):
-    height, width = image.shape
-    image_size = height * width
-    probabilities = histogram / image_size
-
-    optimal_threshold = 0
-    max_variance = 0
-    total_mean = np.sum(np.arange(256) * probabilities.flatten())
-
-    cumulative_prob = 0.0
-    cumulative_mean = 0.0
-
-    for threshold in range(1, 255):
-        p = probabilities[threshold]
-        cumulative_prob += p
-        cumulative_mean += threshold * p
-
-        if cumulative_prob == 0 or cumulative_prob == 1:
+import IntegralHistogram as ih
+import ThresholdLUT as lt
+
+MAX_OTSU_THRESHOLDS = 5
+
+
+def otsu_global_thresholding(image, histogram, number_of_thresholds=1, out=None):
+    thresholds = otsu_thresholds(histogram, number_of_thresholds)
+    return lt.apply_thresholds(image, thresholds, out)
+
+def otsu_thresholds(histogram, number_of_thresholds=1):
+    # A single histogram goes straight to the sequential search, the parallel batch kernel only pays off for many
+    check_number_of_thresholds(number_of_thresholds)
+
+    cumulative_prob, cumulative_mean = cumulative_moments(histogram)
+    return multilevel_otsu_search(cumulative_prob, cumulative_mean, number_of_thresholds)
+
+def otsu_thresholds_batch(histograms, number_of_thresholds=1):
+    """
+    Otsu thresholds of a stack of histograms (n, 256) in one call, returned as (n, number_of_thresholds)
+    """
+    check_number_of_thresholds(number_of_thresholds)
+
+    cumulative_prob, cumulative_mean = cumulative_moments(histograms)
+    return batch_multilevel_otsu_search(cumulative_prob, cumulative_mean, number_of_thresholds)
+
+def check_number_of_thresholds(number_of_thresholds):
+    if not 1 <= number_of_thresholds <= MAX_OTSU_THRESHOLDS:
+        raise ValueError(f"Number of thresholds must be between 1 and {MAX_OTSU_THRESHOLDS} for Otsu Thresholding.")
+
+def cumulative_moments(histograms):
+    # Zeroth and first order cumulative moments, so any class [i, j) is O(1)
+    probabilities = np.asarray(histograms, dtype=np.float64)
+    probabilities = probabilities / np.maximum(probabilities.sum(axis=-1, keepdims=True), 1)
+
+    zeros = np.zeros(probabilities.shape[:-1] + (1,))
+    cumulative_prob = np.concatenate((zeros, np.cumsum(probabilities, axis=-1)), axis=-1)
+    cumulative_mean = np.concatenate((zeros, np.cumsum(np.arange(256) * probabilities, axis=-1)), axis=-1)
+    return cumulative_prob, cumulative_mean
+
+@jit(nopython=True, parallel=True, cache=True)
+def batch_multilevel_otsu_search(cumulative_prob, cumulative_mean, number_of_thresholds):
+    thresholds = np.zeros((cumulative_prob.shape[0], number_of_thresholds), dtype=np.int64)
+    for i in prange(cumulative_prob.shape[0]):
+        thresholds[i] = multilevel_otsu_search(cumulative_prob[i], cumulative_mean[i], number_of_thresholds)
+    return thresholds
+
+@jit(nopython=True, cache=True)
+def multilevel_otsu_search(cumulative_prob, cumulative_mean, number_of_thresholds):
+    """
+    Dynamic programming search for the thresholds maximising the between-class variance.
+    Maximising the variance is the same as maximising sum(mean_k^2 / prob_k) over the classes,
+    which splits into independent terms, so the best split of [0, j) into k classes only
+    depends on the best split of [0, i) into k - 1 classes
+    """
+    levels = cumulative_prob.shape[0] - 1
+    score = np.full((number_of_thresholds, levels), -np.inf)
+    previous = np.zeros((number_of_thresholds, levels), dtype=np.int64)
+
+    # One class covering [0, j)
+    for j in range(1, levels):
+        if cumulative_prob[j] > 0:
+            score[0, j] = cumulative_mean[j] ** 2 / cumulative_prob[j]
+        else:
+            score[0, j] = 0.0
+
+    # k + 1 classes covering [0, j), the last one being [i, j)
+    for k in range(1, number_of_thresholds):
+        for j in range(k + 1, levels):
+            for i in range(k, j):
+                value = score[k - 1, i] + class_score(cumulative_prob, cumulative_mean, i, j)
+                if value > score[k, j]:
+                    score[k, j] = value
+                    previous[k, j] = i
+
+    # Close the last class at the top of the histogram
+    thresholds = np.zeros(number_of_thresholds, dtype=np.int64)
+    best = -np.inf
+    for i in range(number_of_thresholds, levels):
+        value = score[number_of_thresholds - 1, i] + class_score(cumulative_prob, cumulative_mean, i, levels)
+        if value > best:
+            best = value
+            thresholds[-1] = i
+
+    for k in range(number_of_thresholds - 1, 0, -1):
+        thresholds[k - 1] = previous[k, thresholds[k]]
+
+    return thresholds
+
+@jit(nopython=True, cache=True)
+def class_score(cumulative_prob, cumulative_mean, start, end):
+    class_prob = cumulative_prob[end] - cumulative_prob[start]
+    if class_prob <= 0:
+        return 0.0
+    class_mean = cumulative_mean[end] - cumulative_mean[start]
+    return class_mean * class_mean / class_prob
+
+@jit(nopython=True, cache=True)
+def otsu_histogram_threshold(histogram):
+    """
+    Single Otsu threshold of a count histogram in one O(256) pass, for use inside compiled loops
+    """
+    total_count = 0.0
+    total_sum = 0.0
+    for level in range(256):
+        total_count += histogram[level]
+        total_sum += level * histogram[level]
+
+    optimal_threshold = 1
+    max_variance = 0.0
+    background_count = 0.0
+    background_sum = 0.0
+    for threshold in range(1, 256):
+        # empty bins leave both classes unchanged, and the first maximum is kept anyway
+        if histogram[threshold - 1] == 0:
             continue
-
-        background_prob = cumulative_prob
-        object_prob = 1 - cumulative_prob
-
-        background_mean = cumulative_mean / background_prob
-        object_mean = (total_mean - cumulative_mean) / object_prob
-
-        variance_between = background_prob * object_prob * (background_mean - object_mean) ** 2
-
+        background_count += histogram[threshold - 1]
+        background_sum += (threshold - 1) * histogram[threshold - 1]
+        object_count = total_count - background_count
+        if object_count == 0:
+            break
+
+        mean_difference = background_sum / background_count - (total_sum - background_sum) / object_count
+        variance_between = background_count * object_count * mean_difference ** 2
         if variance_between > max_variance:
             max_variance = variance_between
             optimal_threshold = threshold
-    binary_image = np.where(image < optimal_threshold, 0, 255).astype(np.uint8)
-    return binary_image
 
-def local_thresholding(image, number_of_blocks=4, thresholding_method = 'Otsu Thresholding', number_of_thresholds=2):
+    return optimal_threshold
+
+@jit(nopython=True, cache=True)
+def otsu_histogram_thresholds(histogram, number_of_thresholds, occupied_levels, cumulative_prob, cumulative_mean, thresholds):
+    """
+    Multi-level Otsu thresholds of a count histogram, for use inside compiled loops. The search only
+    runs over the occupied gray levels, since a class boundary inside a run of empty bins changes
+    nothing. The scratch arrays hold 256, 257, 257 and number_of_thresholds values; thresholds that
+    don't fit (fewer occupied levels than classes) are set to 256
+    """
+    count = 0
+    cumulative_prob[0] = 0.0
+    cumulative_mean[0] = 0.0
+    for level in range(256):
+        if histogram[level] > 0:
+            occupied_levels[count] = level
+            cumulative_prob[count + 1] = cumulative_prob[count] + histogram[level]
+            cumulative_mean[count + 1] = cumulative_mean[count] + level * histogram[level]
+            count += 1
+
+    thresholds[:] = 256
+    if count <= number_of_thresholds:
+        for i in range(1, count):
+            thresholds[i - 1] = occupied_levels[i]
+        return thresholds
+
+    # Unnormalised moments scale every score by the same total, so the best split is unchanged
+    best = multilevel_otsu_search(cumulative_prob[:count + 1], cumulative_mean[:count + 1], number_of_thresholds)
+    for i in range(number_of_thresholds):
+        thresholds[i] = occupied_levels[best[i]]
+    return thresholds
+
+def local_thresholding(image, number_of_blocks=4, thresholding_method = 'Otsu Thresholding', number_of_thresholds=2,
+                       integral_histogram=None):
+    # For very large scans TileExecutor.local_thresholding spreads the blocks over a process pool
+    blocks, luts = local_block_luts(image, number_of_blocks, thresholding_method, number_of_thresholds, integral_histogram)
+
+    thresholded_image = np.zeros_like(image)
+    for (y_start, y_end, x_start, x_end), lut in zip(blocks, luts):
+        lt.apply_lut(image[y_start:y_end, x_start:x_end], lut, out=thresholded_image[y_start:y_end, x_start:x_end])
+
+    return thresholded_image
+
+def local_block_luts(image, number_of_blocks=4, thresholding_method='Otsu Thresholding', number_of_thresholds=2,
+                     integral_histogram=None):
+    # The blocks of the grid and the lookup table of each, without touching the pixels when an integral histogram is given
+    height, width = image.shape
+    blocks = block_grid(height, width, number_of_blocks)
+    if integral_histogram is not None:
+        histograms = np.array([integral_histogram.histogram(*block) for block in blocks])
+    else:
+        histograms = np.array([np.bincount(image[y_start:y_end, x_start:x_end].ravel(), minlength=256)
+                               for y_start, y_end, x_start, x_end in blocks])
+    return blocks, block_luts(image, blocks, histograms, thresholding_method, number_of_thresholds)
+
+def block_luts(image, blocks, histograms, thresholding_method='Otsu Thresholding', number_of_thresholds=2):
+    # Thresholds of every block in a single batched call, from the block histograms (n, 256)
+    if thresholding_method == 'Otsu Thresholding':
+        thresholds = otsu_thresholds_batch(histograms, number_of_thresholds)
+        counts = np.full(len(blocks), number_of_thresholds)
+
+    elif thresholding_method == 'Optimal Thresholding':
+        block_array = np.array(blocks)
+        corners = image[np.stack([block_array[:, 0], block_array[:, 0], block_array[:, 1] - 1, block_array[:, 1] - 1], axis=1),
+                        np.stack([block_array[:, 2], block_array[:, 3] - 1, block_array[:, 2], block_array[:, 3] - 1], axis=1)]
+        initial_thresholds = ot.initial_thresholds_batch(corners, histograms)
+        thresholds = ot.optimal_thresholds_batch(histograms, initial_thresholds)[:, np.newaxis]
+        counts = np.ones(len(blocks), dtype=np.int64)
+
+    elif thresholding_method == 'Spectral Thresholding':
+        thresholds, counts = st.spectral_thresholds_batch(histograms, number_of_thresholds)
+
+    else:
+        raise ValueError("Invalid method. Choose 'Otsu Thresholding', 'Optimal Thresholding', or 'Spectral Thresholding'.")
+
+    return lt.thresholds_to_luts(thresholds, counts)
+
+def block_grid(height, width, number_of_blocks):
     # Find number of rows and columns for the grid
     rows = int(np.floor(np.sqrt(number_of_blocks)))
     cols = int(np.ceil(number_of_blocks / rows))
-
-    height, width = image.shape
     tile_height = height // rows
-    tile_width = width // cols
-
-    thresholded_image = np.zeros_like(image)
 
-    block_index = 0
+    blocks = []
     for i in range(rows):
-        for j in range(cols):
-            if block_index >= number_of_blocks:
-                break
+        # The last row is split into whatever blocks are left, so the grid always covers the image
+        row_cols = cols if i < rows - 1 else number_of_blocks - (rows - 1) * cols
+        tile_width = width // row_cols
 
-            y_start = i * tile_height
-            y_end = (i + 1) * tile_height if i < rows - 1 else height
+        y_start = i * tile_height
+        y_end = (i + 1) * tile_height if i < rows - 1 else height
+        for j in range(row_cols):
             x_start = j * tile_width
-            x_end = (j + 1) * tile_width if j < cols - 1 else width
+            x_end = (j + 1) * tile_width if j < row_cols - 1 else width
+            blocks.append((y_start, y_end, x_start, x_end))
 
-            block = image[y_start:y_end, x_start:x_end]
-            if thresholding_method == 'Otsu Thresholding':
-                thresholded_block = otsu_global_thresholding(block, np.histogram(block.flatten(), bins=256, range=[0, 256])[0])
+    return blocks
 
-            elif thresholding_method == 'Optimal Thresholding':
-                thresholded_block = ot.OptimalThresholding(block)[0]
-
-            elif thresholding_method == 'Spectral Thresholding':
-                thresholded_block = st.spectral_thresholding(block, np.histogram(block.flatten(), bins=256, range=[0, 256])[0],
-                                                              number_of_thresholds=number_of_thresholds)
-
-            else:
-                raise ValueError("Invalid method. Choose 'Otsu Thresholding', 'Optimal Thresholding', or 'Spectral Thresholding'.")
-                
-            thresholded_image[y_start:y_end, x_start:x_end] = thresholded_block
-
-            block_index += 1
-
-    return thresholded_image
+def block_integral_histogram(image, max_blocks=16):
+    # Index every block boundary used by 1 to max_blocks blocks
+    height, width = image.shape
+    y_knots, x_knots = set(), set()
+    for number_of_blocks in range(1, max_blocks + 1):
+        for y_start, y_end, x_start, x_end in block_grid(height, width, number_of_blocks):
+            y_knots.update((y_start, y_end))
+            x_knots.update((x_start, x_end))
+    return ih.IntegralHistogram(image, sorted(y_knots), sorted(x_knots))
@@ -1,44 +1,164 @@
 import cv2
 import numpy as np
+from numba import jit
+import IntensityIndex as ii
 
-def simultaneous_region_growing(image, seed_points, threshold=10):
+# (dy, dx) of the neighbours visited from every pixel of the wavefront
+NEIGHBOUR_OFFSETS = {4: np.array([(-1, 0), (1, 0), (0, -1), (0, 1)], dtype=np.int64),
+                     8: np.array([(-1, 0), (1, 0), (0, -1), (0, 1), (-1, -1), (-1, 1), (1, -1), (1, 1)], dtype=np.int64)}
+GROWING_CRITERIA = ('seed', 'mean')
+
+
+def simultaneous_region_growing(image, seed_points, threshold=10, connectivity=4, criterion='seed'):
+    """
+    All the seeds grow together, one wavefront layer at a time, and a pixel belongs to the first
+    region that reaches it. With criterion='seed' a pixel joins when it is within threshold of the
+    seed value, with criterion='mean' when it is within threshold of the region's current mean
+    """
+    if connectivity not in NEIGHBOUR_OFFSETS:
+        raise ValueError("Invalid connectivity. Choose 4 or 8.")
+    if criterion not in GROWING_CRITERIA:
+        raise ValueError("Invalid criterion. Choose 'seed' or 'mean'.")
+
+    h, w = image.shape
+    labels = np.zeros((h, w), np.int32)
+    seed_points = np.array([(y, x, seed_value) for y, x, seed_value in seed_points], dtype=np.int64).reshape(-1, 3)
+    region_ids = np.arange(1, len(seed_points) + 1, dtype=np.int32)
+
+    grow_regions(np.ascontiguousarray(image, dtype=np.uint8), labels, seed_points, region_ids, threshold,
+                 NEIGHBOUR_OFFSETS[connectivity], criterion == 'mean')
+    return labels
+
+@jit(nopython=True, cache=True)
+def grow_regions(image, labels, seed_points, region_ids, threshold, offsets, use_region_mean):
+    """
+    Breadth-first growth with a single flat queue of pixel indices: the queue holds the wavefronts
+    one after the other in the same order as growing them layer by layer, and every pixel enters it
+    at most once because it is labeled when it is queued. Pixels already labeled are left untouched
+    """
     h, w = image.shape
-    labels = np.zeros((h, w), np.uint8)
+    number_of_seeds = seed_points.shape[0]
+    queue = np.empty(h * w + number_of_seeds, dtype=np.int64)
+    queue_region = np.empty(h * w + number_of_seeds, dtype=np.int64)
 
-    # Create a list for active growing points: each element is (y, x, region_id, seed_value)
-    active_points = []
+    # The seed value, or the running sum and size of every region for the mean criterion
+    seed_values = np.empty(number_of_seeds, dtype=np.int64)
+    region_sums = np.zeros(number_of_seeds, dtype=np.int64)
+    region_sizes = np.zeros(number_of_seeds, dtype=np.int64)
 
-    for region_id, (y, x, seed_value) in enumerate(seed_points, start=1):
-        active_points.append((y, x, region_id, seed_value))
-        labels[y, x] = region_id  # Label the starting seeds immediately
+    tail = 0
+    for seed in range(number_of_seeds):
+        y, x = seed_points[seed, 0], seed_points[seed, 1]
+        seed_values[seed] = seed_points[seed, 2]
+        labels[y, x] = region_ids[seed]  # Label the starting seeds immediately
+        region_sums[seed] += image[y, x]
+        region_sizes[seed] += 1
+        queue[tail] = y * w + x
+        queue_region[tail] = seed
+        tail += 1
 
-    while active_points:
-        new_active_points = []
+    head = 0
+    while head < tail:
+        y, x = queue[head] // w, queue[head] % w
+        seed = queue_region[head]
+        head += 1
 
-        for y, x, region_id, seed_value in active_points:
-            for dy, dx in [(-1,0), (1,0), (0,-1), (0,1)]:
-                ny, nx = y + dy, x + dx
-                if 0 <= ny < h and 0 <= nx < w:
-                    if labels[ny, nx] == 0:
-                        if abs(int(image[ny, nx]) - int(seed_value)) <= threshold:
-                            labels[ny, nx] = region_id
-                            new_active_points.append((ny, nx, region_id, seed_value))
+        for neighbour in range(offsets.shape[0]):
+            ny, nx = y + offsets[neighbour, 0], x + offsets[neighbour, 1]
+            if 0 <= ny < h and 0 <= nx < w and labels[ny, nx] == 0:
+                if use_region_mean:
+                    difference = abs(image[ny, nx] - region_sums[seed] / region_sizes[seed])
+                else:
+                    difference = abs(np.int64(image[ny, nx]) - seed_values[seed])
+                if difference <= threshold:
+                    labels[ny, nx] = region_ids[seed]
+                    region_sums[seed] += image[ny, nx]
+                    region_sizes[seed] += 1
+                    queue[tail] = ny * w + nx
+                    queue_region[tail] = seed
+                    tail += 1
 
-        active_points = new_active_points  # Move to next layer (wavefront)
+@jit(nopython=True, cache=True)
+def clear_region(labels, y, x, offsets):
+    # A grown region is connected to its seed, so a flood fill from the seed visits only its pixels
+    h, w = labels.shape
+    region_id = labels[y, x]
+    stack = [y * w + x]
+    labels[y, x] = 0
+    while len(stack) > 0:
+        index = stack.pop()
+        y, x = index // w, index % w
+        for neighbour in range(offsets.shape[0]):
+            ny, nx = y + offsets[neighbour, 0], x + offsets[neighbour, 1]
+            if 0 <= ny < h and 0 <= nx < w and labels[ny, nx] == region_id:
+                labels[ny, nx] = 0
+                stack.append(ny * w + nx)
 
-    return labels
+
+class IncrementalRegionGrowing:
+    """
+    Keeps the label map between interactive edits: a new seed only grows its own region into the
+    unlabeled pixels, and removing a seed only clears its region, so each edit costs O(region)
+    rather than O(image). Regions grown one after the other may differ from growing all the seeds
+    simultaneously where two regions compete for the same pixels
+    """
+    def __init__(self, image, threshold=10, connectivity=4, criterion='seed'):
+        if connectivity not in NEIGHBOUR_OFFSETS:
+            raise ValueError("Invalid connectivity. Choose 4 or 8.")
+        if criterion not in GROWING_CRITERIA:
+            raise ValueError("Invalid criterion. Choose 'seed' or 'mean'.")
+
+        self.image = np.ascontiguousarray(image, dtype=np.uint8)
+        self.threshold = threshold
+        self.connectivity = connectivity
+        self.criterion = criterion
+        self.labels = np.zeros(self.image.shape, np.int32)
+        self.seeds = {}  # region id -> (x, y) of its seed
+        self.next_region_id = 1
+
+    def add_seed(self, x, y):
+        # A seed on an already labeled pixel adds nothing, that pixel's region is returned instead
+        if self.labels[y, x] != 0:
+            return int(self.labels[y, x])
+
+        region_id = self.next_region_id
+        self.next_region_id += 1
+        self.seeds[region_id] = (x, y)
+        grow_regions(self.image, self.labels, np.array([(y, x, self.image[y, x])], dtype=np.int64),
+                     np.array([region_id], dtype=np.int32), self.threshold, NEIGHBOUR_OFFSETS[self.connectivity],
+                     self.criterion == 'mean')
+        return region_id
+
+    def remove_region_at(self, x, y):
+        # Clears the region under (x, y) and returns its seed, or None when the pixel is unlabeled
+        region_id = int(self.labels[y, x])
+        if region_id == 0:
+            return None
+        seed_x, seed_y = self.seeds.pop(region_id)
+        clear_region(self.labels, seed_y, seed_x, NEIGHBOUR_OFFSETS[self.connectivity])
+        return seed_x, seed_y
+
+    def color_labels(self):
+        return color_labels(self.labels)
+
+
+def color_labels(labels):
+    return cv2.applyColorMap((labels * 127).astype(np.uint8), cv2.COLORMAP_JET)
 
 
-def ApplyRegionGrowing(image, histogram, threshold =10, manual_selection = False, seeds=None):
+def ApplyRegionGrowing(image, histogram, threshold =10, manual_selection = False, seeds=None, connectivity=4, criterion='seed',
+                       intensity_index=None):
     if manual_selection is False:
         top2_indices = np.argsort(histogram)[-2:][::-1]
+        if intensity_index is None:
+            intensity_index = ii.IntensityIndex(image)
 
         # Step 2: Pick one seed per peak
         seed_points = []
         for peak in top2_indices:
-            points = np.argwhere(image == peak)
-            if len(points) > 0:
-                y, x = points[0]  # pick the first match (could randomize)
+            point = intensity_index.first_position(peak)
+            if point is not None:
+                y, x = point  # pick the first match (could randomize)
                 seed_points.append((y, x, peak))
                 print(seed_points)
     else:
@@ -48,6 +168,5 @@ def ApplyRegionGrowing(image, histogram, threshold =10, manual_selection = False
             print(seed_points)
 
         # Step 3: Simultaneous region growing
-    labels = simultaneous_region_growing(image, seed_points, threshold)
-    color_labels = cv2.applyColorMap((labels * 127).astype(np.uint8), cv2.COLORMAP_JET)
-    return color_labels
+    labels = simultaneous_region_growing(image, seed_points, threshold, connectivity, criterion)
+    return color_labels(labels)
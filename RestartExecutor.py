@@ -0,0 +1,67 @@
+import os
+import multiprocessing
+import numpy as np
+import numba
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+# One pool for the whole session, its workers keep their compiled kernels between calls
+restart_pool = None
+restart_pool_workers = 0
+
+
+def parallel_restarts(fit_restart, pixel_values, weights, number_of_clusters, initialization, seeds, algorithm, memory_budget,
+                      batch_size, workers=None):
+    """
+    fit_restart (a module-level function, e.g. KMeansClustering.fit_restart) for every seed on a process pool.
+    The points (and weights) are copied once into shared memory, the workers only receive the names of the
+    buffers and send back (inertia, centers)
+    """
+    workers = min(workers or os.cpu_count(), len(seeds))
+    arrays = [np.ascontiguousarray(pixel_values)] + ([] if weights is None else [np.ascontiguousarray(weights)])
+    buffers = [shared_memory.SharedMemory(create=True, size=max(1, array.nbytes)) for array in arrays]
+    try:
+        descriptions = []
+        for array, buffer in zip(arrays, buffers):
+            np.ndarray(array.shape, dtype=array.dtype, buffer=buffer.buf)[...] = array
+            descriptions.append((buffer.name, array.shape, array.dtype.str))
+
+        tasks = [(fit_restart, descriptions, number_of_clusters, initialization, seed, algorithm, memory_budget, batch_size)
+                 for seed in seeds]
+        results = list(get_restart_pool(workers).map(run_restart, tasks))
+    finally:
+        for buffer in buffers:
+            buffer.close()
+            buffer.unlink()
+
+    return results
+
+def get_restart_pool(workers):
+    global restart_pool, restart_pool_workers
+    if restart_pool is None or restart_pool_workers != workers:
+        if restart_pool is not None:
+            restart_pool.shutdown()
+        # Spawned rather than forked: forking after numba's parallel kernels have run hangs the parent at exit
+        restart_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                           initializer=limit_worker_threads, initargs=(max(1, os.cpu_count() // workers),))
+        restart_pool_workers = workers
+    return restart_pool
+
+def limit_worker_threads(threads):
+    # The workers share the cores, each one's parallel kernels only get its share of the threads
+    numba.set_num_threads(threads)
+
+def run_restart(task):
+    fit_restart, descriptions, number_of_clusters, initialization, seed, algorithm, memory_budget, batch_size = task
+    buffers = [shared_memory.SharedMemory(name=name) for name, _, _ in descriptions]
+    try:
+        arrays = [np.ndarray(shape, dtype=np.dtype(dtype), buffer=buffer.buf)
+                  for buffer, (_, shape, dtype) in zip(buffers, descriptions)]
+        pixel_values, weights = arrays[0], (arrays[1] if len(arrays) > 1 else None)
+        inertia, centers = fit_restart(pixel_values, weights, number_of_clusters, initialization, seed, algorithm,
+                                       memory_budget, batch_size)
+        del arrays, pixel_values, weights  # release the views before closing the buffers
+    finally:
+        for buffer in buffers:
+            buffer.close()
+    return inertia, centers
@@ -0,0 +1,108 @@
+import numpy as np
+from numba import jit, prange, get_num_threads
+import OtsuThresholding as otsu
+import OptimalThresholding as ot
+import SpectralThresholding as st
+
+THRESHOLDING_METHODS = {'Otsu Thresholding': 0, 'Optimal Thresholding': 1, 'Spectral Thresholding': 2}
+
+
+def sliding_window_thresholding(image, window_size=31, thresholding_method='Otsu Thresholding', number_of_thresholds=2):
+    """
+    Per-pixel local thresholding: every pixel is thresholded with the criterion computed on the
+    window_size x window_size neighbourhood around it (clipped at the image borders).
+    Otsu and Spectral use number_of_thresholds thresholds, Optimal gives a binary image
+    """
+    if thresholding_method not in THRESHOLDING_METHODS:
+        raise ValueError("Invalid method. Choose 'Otsu Thresholding', 'Optimal Thresholding', or 'Spectral Thresholding'.")
+    if thresholding_method == 'Otsu Thresholding':
+        otsu.check_number_of_thresholds(number_of_thresholds)
+    if window_size < 3 or window_size % 2 == 0:
+        raise ValueError("Window size must be an odd number of at least 3.")
+
+    image = np.ascontiguousarray(image, dtype=np.uint8)
+    number_of_bands = max(1, min(get_num_threads(), image.shape[0]))
+    return sliding_window_kernel(image, window_size // 2, THRESHOLDING_METHODS[thresholding_method],
+                                 number_of_thresholds, number_of_bands)
+
+@jit(nopython=True, parallel=True)
+def sliding_window_kernel(image, radius, method, number_of_thresholds, number_of_bands):
+    """
+    The window histogram is kept up to date incrementally (Huang): moving one pixel to the right
+    adds the entering column and drops the leaving one. Each column histogram itself only gains a
+    row and loses a row per image row (Perreault), so the cost per pixel is O(256) whatever the
+    window size. Horizontal bands of rows run in parallel, each with its own column histograms
+    """
+    height, width = image.shape
+    thresholded_image = np.zeros_like(image)
+    band_height = (height + number_of_bands - 1) // number_of_bands
+
+    for band in prange(number_of_bands):
+        y_start = band * band_height
+        y_end = min(y_start + band_height, height)
+
+        column_histograms = np.zeros((width, 256), dtype=np.int32)
+        window_histogram = np.zeros(256, dtype=np.int32)
+        peaks = np.empty((2, 256), dtype=np.int64)
+        thresholds = np.empty(max(number_of_thresholds, 1), dtype=np.int64)
+        occupied_levels = np.empty(256, dtype=np.int64)
+        cumulative_prob = np.empty(257)
+        cumulative_mean = np.empty(257)
+
+        # rows [top, bottom) are currently counted in the column histograms
+        top = max(0, y_start - radius)
+        bottom = top
+        for y in range(y_start, y_end):
+            while bottom < min(height, y + radius + 1):
+                for x in range(width):
+                    column_histograms[x, image[bottom, x]] += 1
+                bottom += 1
+            while top < y - radius:
+                for x in range(width):
+                    column_histograms[x, image[top, x]] -= 1
+                top += 1
+
+            window_histogram[:] = 0
+            for x in range(min(width, radius + 1)):
+                window_histogram += column_histograms[x]
+
+            for x in range(width):
+                if x > 0:
+                    if x + radius < width:
+                        window_histogram += column_histograms[x + radius]
+                    if x - radius - 1 >= 0:
+                        window_histogram -= column_histograms[x - radius - 1]
+
+                value = image[y, x]
+                if method == 2:
+                    count = st.histogram_peak_thresholds(window_histogram, number_of_thresholds, peaks, thresholds)
+                    if count > 0:
+                        level = 0
+                        while level < count and value >= thresholds[level]:
+                            level += 1
+                        thresholded_image[y, x] = 255 * level // count
+                elif method == 0 and number_of_thresholds > 1:
+                    otsu.otsu_histogram_thresholds(window_histogram, number_of_thresholds, occupied_levels,
+                                                   cumulative_prob, cumulative_mean, thresholds)
+                    level = 0
+                    while level < number_of_thresholds and value >= thresholds[level]:
+                        level += 1
+                    thresholded_image[y, x] = 255 * level // number_of_thresholds
+                else:
+                    if method == 0:
+                        threshold = otsu.otsu_histogram_threshold(window_histogram)
+                    else:
+                        threshold = ot.calculate_new_threshold(window_histogram, window_mean(window_histogram))
+                    if value >= threshold:
+                        thresholded_image[y, x] = 255
+
+    return thresholded_image
+
+@jit(nopython=True)
+def window_mean(histogram):
+    count = 0
+    total = 0
+    for level in range(256):
+        count += histogram[level]
+        total += level * histogram[level]
+    return total // count
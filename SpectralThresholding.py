@@ -1,8 +1,15 @@
 import numpy as np
+from numba import jit, prange
 from scipy.signal import find_peaks
+import ThresholdLUT as lt
 
 
-def spectral_thresholding(grayscale_image, histogram, number_of_thresholds=2):
+def spectral_thresholding(grayscale_image, histogram, number_of_thresholds=2, out=None):
+    thresholds = spectral_thresholds(histogram, number_of_thresholds)
+    # With a single peak there is no threshold and the whole image is one segment
+    return lt.apply_thresholds(grayscale_image, thresholds, out)
+
+def spectral_thresholds(histogram, number_of_thresholds=2):
     # Find peaks in the histogram
     peaks, _ = find_peaks(histogram, height=0, distance=20)
     
@@ -19,20 +26,101 @@ def spectral_thresholding(grayscale_image, histogram, number_of_thresholds=2):
     for i in range(len(main_peaks) - 1):
         threshold = (main_peaks[i] + main_peaks[i + 1]) // 2
         thresholds.append(threshold)
-    
-    # Create segmented image
-    thresholded_image = np.zeros_like(grayscale_image)
-    
-    # Apply thresholding
-    for i in range(len(thresholds) + 1):
-        if i == 0:
-            mask = grayscale_image < thresholds[i]
-        elif i == len(thresholds):
-            mask = grayscale_image >= thresholds[i - 1]
-        else:
-            mask = (grayscale_image >= thresholds[i - 1]) & (grayscale_image < thresholds[i])
-        
-        # Assign different intensity values to each segment
-        thresholded_image[mask] = int(255 * i / len(thresholds))
-
-    return thresholded_image
+    return thresholds
+
+def spectral_thresholds_batch(histograms, number_of_thresholds=2):
+    """
+    Spectral thresholds of a stack of histograms (n, 256) in one compiled call.
+    Returns the thresholds (n, number_of_thresholds) and how many are valid in each row
+    """
+    histograms = np.ascontiguousarray(histograms, dtype=np.int64)
+    thresholds = np.zeros((histograms.shape[0], number_of_thresholds), dtype=np.int64)
+    counts = np.zeros(histograms.shape[0], dtype=np.int64)
+    batch_histogram_peak_thresholds(histograms, number_of_thresholds, thresholds, counts)
+    return thresholds, counts
+
+@jit(nopython=True, parallel=True, cache=True)
+def batch_histogram_peak_thresholds(histograms, number_of_thresholds, thresholds, counts):
+    for i in prange(histograms.shape[0]):
+        peaks = np.empty((2, 256), dtype=np.int64)
+        counts[i] = histogram_peak_thresholds(histograms[i], number_of_thresholds, peaks, thresholds[i])
+
+@jit(nopython=True, cache=True)
+def histogram_peak_thresholds(histogram, number_of_thresholds, peaks, thresholds, distance=20):
+    """
+    Compiled counterpart of the threshold selection in spectral_thresholding, for use inside
+    per-pixel or per-tile loops. peaks is a (2, 256) scratch buffer and thresholds holds at
+    least number_of_thresholds entries; returns how many thresholds were written
+    """
+    number_of_peaks = find_histogram_peaks(histogram, peaks, distance)
+    if number_of_peaks < 2:
+        return 0
+
+    # Keep the highest peaks (selection marks them in peaks[1]), intensity order is preserved
+    num_peaks = min(number_of_thresholds + 1, number_of_peaks)
+    peaks[1, :number_of_peaks] = 0
+    for _ in range(num_peaks):
+        best = highest_unmarked_peak(histogram, peaks, number_of_peaks)
+        peaks[1, best] = 1
+
+    count = 0
+    previous_peak = -1
+    for i in range(number_of_peaks):
+        if peaks[1, i] == 1:
+            if previous_peak >= 0:
+                thresholds[count] = (previous_peak + peaks[0, i]) // 2
+                count += 1
+            previous_peak = peaks[0, i]
+    return count
+
+@jit(nopython=True, cache=True)
+def find_histogram_peaks(histogram, peaks, distance):
+    """
+    Same peaks as scipy.signal.find_peaks(histogram, height=0, distance=distance), written to
+    peaks[0]: local maxima with flat tops reported at their middle, then the highest peaks
+    suppress lower ones closer than distance. Equal heights are resolved towards higher intensity
+    """
+    number_of_peaks = 0
+    i = 1
+    i_max = histogram.shape[0] - 1
+    while i < i_max:
+        if histogram[i - 1] < histogram[i]:
+            i_ahead = i + 1
+            while i_ahead < i_max and histogram[i_ahead] == histogram[i]:
+                i_ahead += 1
+            if histogram[i_ahead] < histogram[i]:
+                peaks[0, number_of_peaks] = (i + i_ahead - 1) // 2
+                number_of_peaks += 1
+                i = i_ahead
+        i += 1
+
+    # peaks[1]: 0 undecided, 1 kept, 2 suppressed
+    peaks[1, :number_of_peaks] = 0
+    while True:
+        j = highest_unmarked_peak(histogram, peaks, number_of_peaks)
+        if j < 0:
+            break
+        peaks[1, j] = 1
+        k = j - 1
+        while k >= 0 and peaks[0, j] - peaks[0, k] < distance:
+            peaks[1, k] = 2
+            k -= 1
+        k = j + 1
+        while k < number_of_peaks and peaks[0, k] - peaks[0, j] < distance:
+            peaks[1, k] = 2
+            k += 1
+
+    kept = 0
+    for i in range(number_of_peaks):
+        if peaks[1, i] == 1:
+            peaks[0, kept] = peaks[0, i]
+            kept += 1
+    return kept
+
+@jit(nopython=True, cache=True)
+def highest_unmarked_peak(histogram, peaks, number_of_peaks):
+    best = -1
+    for i in range(number_of_peaks):
+        if peaks[1, i] == 0 and (best < 0 or histogram[peaks[0, i]] >= histogram[peaks[0, best]]):
+            best = i
+    return best
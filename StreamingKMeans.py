@@ -0,0 +1,53 @@
+import os
+import cv2
+import numpy as np
+import KMeansClustering as km
+
+
+def fit_palette(images, number_of_clusters=8, batch_size=4096, batches_per_image=20, seed=42):
+    """
+    Fits one set of k-means centers over a whole collection of images with mini-batches, keeping a
+    single image in memory at a time. images is a directory or an iterable of RGB arrays or file
+    paths. Every image moves the centers by up to batches_per_image batches, with the per-center
+    learning rates carried from image to image, so later images refine rather than overwrite them.
+    The first image seeds the centers with k-means++
+    """
+    rng = np.random.default_rng(seed)
+    centers = None
+    seen_counts = np.zeros(number_of_clusters, dtype=np.int64)
+
+    for image in iterate_images(images):
+        pixel_values = image.reshape((-1, 3))
+        if centers is None:
+            sample = pixel_values[rng.integers(0, pixel_values.shape[0], size=min(pixel_values.shape[0], 16 * batch_size))]
+            centers = km.k_means_plus_plus(sample, None, number_of_clusters, rng)
+        centers = km.mini_batch_centers(pixel_values, centers, batches_per_image, batch_size, seed=int(rng.integers(2**31)),
+                                        seen_counts=seen_counts)
+
+    if centers is None:
+        raise ValueError("No images to fit the palette on.")
+    return centers
+
+def apply_palette(image, centers):
+    # Assignment-only pass: every pixel takes the color of its nearest palette center
+    pixel_values = image.reshape((-1, 3))
+    labels = np.empty(pixel_values.shape[0], dtype=np.int32)
+    km.fused_assign_update(pixel_values, centers, labels)
+    return np.uint8(centers)[labels].reshape(image.shape)
+
+def segment_images(images, centers):
+    # Lazily segments every image with the same palette, one image in memory at a time
+    for image in iterate_images(images):
+        yield apply_palette(image, centers)
+
+def iterate_images(images):
+    # RGB arrays from a directory, or from an iterable of arrays and file paths
+    if isinstance(images, str):
+        images = [os.path.join(images, file_name) for file_name in sorted(os.listdir(images))]
+    for image in images:
+        if isinstance(image, str):
+            bgr_image = cv2.imread(image, cv2.IMREAD_COLOR)
+            if bgr_image is None:
+                continue  # not an image
+            image = cv2.cvtColor(bgr_image, cv2.COLOR_BGR2RGB)
+        yield image
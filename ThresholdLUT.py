@@ -0,0 +1,31 @@
+import cv2
+import numpy as np
+
+
+def apply_thresholds(image, thresholds, out=None):
+    return apply_lut(image, thresholds_to_lut(thresholds), out)
+
+def thresholds_to_lut(thresholds):
+    # Class index of every gray level (how many thresholds it reaches), spread evenly over [0, 255]
+    thresholds = np.asarray(thresholds, dtype=np.int64).reshape(1, -1)
+    return thresholds_to_luts(thresholds, np.array([thresholds.shape[1]]))[0]
+
+def thresholds_to_luts(thresholds, counts):
+    """
+    One lookup table per row of thresholds (n, max_thresholds), of which only the first counts[i]
+    are used. A row without thresholds maps everything to 0
+    """
+    thresholds = np.asarray(thresholds, dtype=np.int64)
+    counts = np.asarray(counts, dtype=np.int64)
+    valid = np.arange(thresholds.shape[1]) < counts[:, np.newaxis]
+    class_index = ((np.arange(256) >= thresholds[:, :, np.newaxis]) & valid[:, :, np.newaxis]).sum(axis=1)
+    return (255 * class_index // np.maximum(counts, 1)[:, np.newaxis]).astype(np.uint8)
+
+def apply_lut(image, lut, out=None):
+    # A single pass over the pixels however many levels there are; out may be a view into a larger image
+    if out is None:
+        return cv2.LUT(image, lut)
+    result = cv2.LUT(image, lut, dst=out)
+    if result is not out:  # OpenCV could not write into out directly
+        out[...] = result
+    return out
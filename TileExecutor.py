@@ -0,0 +1,156 @@
+import os
+import multiprocessing
+import numpy as np
+import numba
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+import OtsuThresholding as otsu
+import ThresholdLUT as lt
+
+# Below this many pixels the batched in-process path (a few tens of milliseconds) beats handing strips to the pool
+PARALLEL_MIN_PIXELS = 4 * 1024 * 1024
+# Row strips per worker, so a slow strip doesn't leave the other workers idle
+STRIPS_PER_WORKER = 4
+
+# One pool for the whole session, its workers keep their imports between calls
+tile_pool = None
+tile_pool_workers = 0
+# Shared segments a worker has attached, by name; only the current session image stays attached
+attached_buffers = {}
+
+
+class SharedImage:
+    """
+    A grayscale image copied once into shared memory for the whole session, with an output buffer of
+    the same size that the workers write into. Call close() when the image is replaced
+    """
+    def __init__(self, image):
+        self.shape = image.shape
+        self.image_buffer = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        self.output_buffer = shared_memory.SharedMemory(create=True, size=max(1, image.nbytes))
+        self.image = np.ndarray(self.shape, dtype=np.uint8, buffer=self.image_buffer.buf)
+        self.output = np.ndarray(self.shape, dtype=np.uint8, buffer=self.output_buffer.buf)
+        self.image[:] = image
+
+    @property
+    def size(self):
+        return self.image.size
+
+    def close(self):
+        self.image = self.output = None
+        for buffer in (self.image_buffer, self.output_buffer):
+            try:
+                buffer.close()
+            except BufferError:
+                pass  # a result is still viewed somewhere, the mapping goes away with its last view
+            buffer.unlink()
+
+
+def local_thresholding(image, number_of_blocks=4, thresholding_method='Otsu Thresholding', number_of_thresholds=2,
+                       integral_histogram=None, workers=None):
+    """
+    otsu.local_thresholding for a SharedImage (or a plain array), spread over a process pool (workers,
+    None for one per core) when the image is large enough for the pool to pay off. A pooled result of
+    a SharedImage is its output buffer, valid until the next call
+    """
+    workers = workers or os.cpu_count()
+    source = image.image if isinstance(image, SharedImage) else image
+    if workers == 1 or source.size < PARALLEL_MIN_PIXELS:
+        return otsu.local_thresholding(source, number_of_blocks, thresholding_method, number_of_thresholds, integral_histogram)
+
+    if isinstance(image, SharedImage):
+        return parallel_local_thresholding(image, number_of_blocks, thresholding_method, number_of_thresholds,
+                                           integral_histogram, workers)
+    shared = SharedImage(image)
+    try:
+        return parallel_local_thresholding(shared, number_of_blocks, thresholding_method, number_of_thresholds,
+                                           integral_histogram, workers).copy()
+    finally:
+        shared.close()
+
+def parallel_local_thresholding(shared, number_of_blocks=4, thresholding_method='Otsu Thresholding', number_of_thresholds=2,
+                                integral_histogram=None, workers=None):
+    """
+    local_thresholding of a SharedImage on the process pool. The work is split into row strips, however
+    many blocks there are: the workers add up the block histograms of their strips (unless an integral
+    histogram is given), the thresholds of all blocks are found here in one batched call, and the workers
+    apply the block lookup tables to their strips straight into the shared output buffer
+    """
+    if thresholding_method not in ('Otsu Thresholding', 'Optimal Thresholding', 'Spectral Thresholding'):
+        raise ValueError("Invalid method. Choose 'Otsu Thresholding', 'Optimal Thresholding', or 'Spectral Thresholding'.")
+    if thresholding_method == 'Otsu Thresholding':
+        otsu.check_number_of_thresholds(number_of_thresholds)
+
+    workers = workers or os.cpu_count()
+    height, width = shared.shape
+    blocks = np.array(otsu.block_grid(height, width, number_of_blocks))
+    strip_edges = np.linspace(0, height, min(height, STRIPS_PER_WORKER * workers) + 1).astype(np.int64)
+    names = (shared.image_buffer.name, shared.output_buffer.name, shared.shape)
+    pool = get_tile_pool(workers)
+
+    if integral_histogram is not None:
+        histograms = np.array([integral_histogram.histogram(*block) for block in blocks])
+    else:
+        tasks = [(names, strip_start, strip_end, blocks) for strip_start, strip_end in zip(strip_edges[:-1], strip_edges[1:])]
+        histograms = sum(pool.map(strip_block_histograms, tasks))
+    luts = otsu.block_luts(shared.image, blocks, histograms, thresholding_method, number_of_thresholds)
+
+    tasks = [(names, strip_start, strip_end, blocks, luts) for strip_start, strip_end in zip(strip_edges[:-1], strip_edges[1:])]
+    for _ in pool.map(apply_strip_luts, tasks):
+        pass
+
+    return shared.output
+
+def get_tile_pool(workers):
+    global tile_pool, tile_pool_workers
+    if tile_pool is None or tile_pool_workers != workers:
+        if tile_pool is not None:
+            tile_pool.shutdown()
+        # Spawned rather than forked: forking after numba's parallel kernels have run hangs the parent at exit
+        tile_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                        initializer=single_threaded_worker)
+        tile_pool_workers = workers
+    return tile_pool
+
+def prepare_tile_pool(image_size, workers=None):
+    # Starts the workers in the background when images of this size will go to the pool, so the first call doesn't wait
+    workers = workers or os.cpu_count()
+    if workers > 1 and image_size >= PARALLEL_MIN_PIXELS:
+        pool = get_tile_pool(workers)
+        for _ in range(workers):
+            pool.submit(single_threaded_worker)
+
+def single_threaded_worker():
+    # The pool already runs one task per core, more numba threads per worker would oversubscribe them
+    numba.set_num_threads(1)
+
+def attached_arrays(names):
+    # Views on the shared image and output; a new session image replaces the previous attachment
+    image_name, output_name, shape = names
+    if image_name not in attached_buffers:
+        for buffer in attached_buffers.values():
+            buffer.close()
+        attached_buffers.clear()
+        attached_buffers[image_name] = shared_memory.SharedMemory(name=image_name)
+        attached_buffers[output_name] = shared_memory.SharedMemory(name=output_name)
+    return (np.ndarray(shape, dtype=np.uint8, buffer=attached_buffers[image_name].buf),
+            np.ndarray(shape, dtype=np.uint8, buffer=attached_buffers[output_name].buf))
+
+def strip_block_histograms(task):
+    # Histograms (blocks, 256) of the part of every block that lies in the strip
+    names, strip_start, strip_end, blocks = task
+    image, _ = attached_arrays(names)
+    histograms = np.zeros((len(blocks), 256), dtype=np.int64)
+    for index, (y_start, y_end, x_start, x_end) in enumerate(blocks):
+        y_start, y_end = max(y_start, strip_start), min(y_end, strip_end)
+        if y_start < y_end:
+            histograms[index] = np.bincount(image[y_start:y_end, x_start:x_end].ravel(), minlength=256)
+    return histograms
+
+def apply_strip_luts(task):
+    names, strip_start, strip_end, blocks, luts = task
+    image, output = attached_arrays(names)
+    for (y_start, y_end, x_start, x_end), lut in zip(blocks, luts):
+        y_start, y_end = max(y_start, strip_start), min(y_end, strip_end)
+        if y_start < y_end:
+            lt.apply_lut(image[y_start:y_end, x_start:x_end], lut, out=output[y_start:y_end, x_start:x_end])
@@ -46,19 +46,37 @@ class ImageSegmentationUI(object):
 
         self.applyThresholdingButton = QPushButton("Apply Thresholding")
 
+        self.liveThresholdingCheckBox = QCheckBox("Live Preview")
+        self.liveThresholdingCheckBox.setStyleSheet("QCheckBox { color: white; font-size: 14px; font: bold; }")
+
         self.localThresholdingCheckBox = QCheckBox("Local Thresholding")
         self.localThresholdingCheckBox.setStyleSheet("QCheckBox { color: white; font-size: 14px; font: bold; }")
         self.localThresholdingCheckBox.stateChanged.connect(lambda state: toggle_layout(self.numberOfBlocksLayout, state))
 
-        self.numberOfBlocksLabel = QLabel(f"Number of Blocks {1}")
+        self.numberOfBlocksLabel = QLabel(f"Number of Blocks {4}")
         self.numberOfBlocksLabel.setStyleSheet(LABEL_STYLESHEET)
         self.numberOfBlocksSlider = QSlider()
         self.numberOfBlocksSlider.setOrientation(QtCore.Qt.Horizontal)
         self.numberOfBlocksSlider.setRange(1, 16)
+        self.numberOfBlocksSlider.setValue(4)
         self.numberOfBlocksSlider.valueChanged.connect(lambda value: update_label_text(self.numberOfBlocksLabel, f"Number of Blocks: {value}"))
 
+        self.slidingWindowCheckBox = QCheckBox("Per-pixel Window")
+        self.slidingWindowCheckBox.setStyleSheet("QCheckBox { color: white; font-size: 14px; font: bold; }")
+
+        self.windowSizeLabel = QLabel(f"Window Size {31}")
+        self.windowSizeLabel.setStyleSheet(LABEL_STYLESHEET)
+        self.windowSizeSlider = QSlider()
+        self.windowSizeSlider.setOrientation(QtCore.Qt.Horizontal)
+        self.windowSizeSlider.setRange(1, 50)  # window size is 2 * value + 1
+        self.windowSizeSlider.setValue(15)
+        self.windowSizeSlider.valueChanged.connect(lambda value: update_label_text(self.windowSizeLabel, f"Window Size: {2 * value + 1}"))
+
         self.numberOfBlocksLayout.addWidget(self.numberOfBlocksLabel, 0, 0, 1, 1)
         self.numberOfBlocksLayout.addWidget(self.numberOfBlocksSlider, 0, 1, 1, 1)
+        self.numberOfBlocksLayout.addWidget(self.slidingWindowCheckBox, 1, 0, 1, 2)
+        self.numberOfBlocksLayout.addWidget(self.windowSizeLabel, 2, 0, 1, 1)
+        self.numberOfBlocksLayout.addWidget(self.windowSizeSlider, 2, 1, 1, 1)
         toggle_layout(self.numberOfBlocksLayout, False)
 
         self.numberOfThresholdsLabel = QLabel(f"Number of Thresholds {1}")
@@ -77,7 +95,8 @@ class ImageSegmentationUI(object):
         self.thresholdingControlsLayout.addLayout(self.numberOfBlocksLayout, 2, 1, 1, 1)
         self.thresholdingControlsLayout.addWidget(self.thresholdingMethodComboBox, 3, 0, 1, 2)
         self.thresholdingControlsLayout.addLayout(self.numberOfThresholdsLayout, 4, 0, 1, 2)
-        self.thresholdingControlsLayout.addWidget(self.applyThresholdingButton, 5, 0, 1, 2)
+        self.thresholdingControlsLayout.addWidget(self.liveThresholdingCheckBox, 5, 0, 1, 2)
+        self.thresholdingControlsLayout.addWidget(self.applyThresholdingButton, 6, 0, 1, 2)
 
         
         self.segmentationControlsLabel = QLabel("Segmentation Controls")
@@ -99,6 +118,10 @@ class ImageSegmentationUI(object):
         self.numberOfClustersSlider.valueChanged.connect(lambda value: update_label_text(self.numberOfClustersLabel,
                                                                                           f"Number of Clusters: {value}"))
 
+        self.kMeansAlgorithmComboBox = QComboBox()
+        self.kMeansAlgorithmComboBox.setStyleSheet(COMBOBOX_STYLESHEET)
+        self.kMeansAlgorithmComboBox.addItems(["Full Batch", "Mini-batch", "Hamerly"])
+
         self.manualPointSelectionCheckBox = QCheckBox("Manual Point Selection")
         self.manualPointSelectionCheckBox.setStyleSheet("QCheckBox { color: white; font-size: 14px; font: bold; }")
 
@@ -106,6 +129,12 @@ class ImageSegmentationUI(object):
         self.resetPointsButton.setStyleSheet("QPushButton { color: white; font-size: 14px; font: bold; }")
         self.resetPointsButton.clicked.connect(MainWindow.resetPoints)
 
+        self.connectivityCheckBox = QCheckBox("Merge Neighbours Only")
+        self.connectivityCheckBox.setStyleSheet("QCheckBox { color: white; font-size: 14px; font: bold; }")
+
+        self.smoothSegmentsCheckBox = QCheckBox("Smooth Segments")
+        self.smoothSegmentsCheckBox.setStyleSheet("QCheckBox { color: white; font-size: 14px; font: bold; }")
+
         self.spatialBandwidthLabel = QLabel(f"Spatial Bandwidth {0.05}")
         self.spatialBandwidthLabel.setStyleSheet(LABEL_STYLESHEET)
         self.spatialBandwidthSlider = QSlider()
@@ -160,10 +189,13 @@ class ImageSegmentationUI(object):
         self.kMeansClusteringLayout.addWidget(self.numberOfClustersLabel, 1, 0, 1, 1)
         self.kMeansClusteringLayout.addWidget(self.numberOfClustersSlider, 1, 1, 1, 1)
         self.kMeansClusteringLayout.addWidget(self.resetPointsButton, 2, 0, 1, 2)
+        self.kMeansClusteringLayout.addWidget(self.kMeansAlgorithmComboBox, 3, 0, 1, 2)
 
         self.agglomerativeClusteringLayout.addWidget(self.numberOfClustersLabel, 0, 0, 1, 1)
         self.agglomerativeClusteringLayout.addWidget(self.numberOfClustersSlider, 0, 1, 1, 1)
-        self.agglomerativeClusteringLayout.addWidget(self.agglomerativeClusteringProgressBar, 1, 0, 1, 2)
+        self.agglomerativeClusteringLayout.addWidget(self.connectivityCheckBox, 1, 0, 1, 2)
+        self.agglomerativeClusteringLayout.addWidget(self.smoothSegmentsCheckBox, 2, 0, 1, 2)
+        self.agglomerativeClusteringLayout.addWidget(self.agglomerativeClusteringProgressBar, 3, 0, 1, 2)
 
         toggle_layout(self.agglomerativeClusteringLayout, False)
         toggle_layout(self.kMeansClusteringLayout, True)
@@ -197,10 +229,12 @@ class ImageSegmentationUI(object):
 
     def show_controls_layout(self, method):
         if method == "Spectral Thresholding":
+            self.numberOfThresholdsSlider.setRange(1, 16)
             toggle_layout(self.numberOfThresholdsLayout, True)
 
         elif method == "Otsu Thresholding":
-            toggle_layout(self.numberOfThresholdsLayout, False)
+            self.numberOfThresholdsSlider.setRange(1, 5)  # multi-level Otsu supports up to 5 thresholds
+            toggle_layout(self.numberOfThresholdsLayout, True)
 
         elif method == "Optimal Thresholding":
             toggle_layout(self.numberOfThresholdsLayout, False)
@@ -0,0 +1,124 @@
+import os
+import re
+import sys
+import glob
+import cv2
+import numpy as np
+import KMeansClustering as km
+import OtsuThresholding as otsu
+import OptimalThresholding as ot
+import SpectralThresholding as st
+import ThresholdLUT as lt
+import shift_mean_segmentation as ms
+
+IMAGE_EXTENSIONS = ('.png', '.jpg', '.jpeg', '.bmp', '.webp', '.tif', '.tiff')
+
+
+def read_frames(source):
+    """
+    Streams RGB frames one at a time from a video file, a directory of numbered frames, a glob
+    pattern ('frames/*.png') or a printf pattern ('frames/%04d.png'); the clip is never loaded whole
+    """
+    if os.path.isdir(source) or any(character in source for character in '*?['):
+        paths = glob.glob(os.path.join(source, '*')) if os.path.isdir(source) else glob.glob(source)
+        paths.sort(key=natural_sort_key)
+        for path in paths:
+            if path.lower().endswith(IMAGE_EXTENSIONS):
+                bgr_frame = cv2.imread(path, cv2.IMREAD_COLOR)
+                if bgr_frame is not None:
+                    yield cv2.cvtColor(bgr_frame, cv2.COLOR_BGR2RGB)
+        return
+
+    # video files and printf-style image sequences are both decoded by VideoCapture
+    capture = cv2.VideoCapture(source)
+    if not capture.isOpened():
+        raise ValueError(f"Cannot open video or frame sequence '{source}'.")
+    try:
+        while True:
+            success, bgr_frame = capture.read()
+            if not success:
+                break
+            yield cv2.cvtColor(bgr_frame, cv2.COLOR_BGR2RGB)
+    finally:
+        capture.release()
+
+def natural_sort_key(path):
+    # frame_2.png before frame_10.png: runs of digits compare as numbers, the rest as text
+    return [int(part) if part.isdigit() else part.lower() for part in re.split(r'(\d+)', path)]
+
+def k_means_frames(frames, number_of_clusters=3, algorithm='full', coreset='unique'):
+    """
+    K-means on every frame, each frame starting from the centers of the previous one (the first
+    from k-means++), so similar frames converge in one or two iterations
+    """
+    centers = None
+    for frame in frames:
+        pixel_values = frame.reshape((-1, 3))
+        weights = None
+        if coreset is not None:
+            pixel_values, weights, inverse = km.color_coreset(pixel_values, coreset)
+        if centers is None:
+            centers = km.k_means_plus_plus(pixel_values, weights, number_of_clusters, np.random.default_rng(42))
+
+        labels = np.empty(pixel_values.shape[0], dtype=np.int32)
+        centers = km.fit_centers(pixel_values, weights, centers, labels, algorithm)
+        if coreset is not None:
+            labels = labels[inverse]
+        yield np.uint8(centers)[labels].reshape(frame.shape)
+
+def thresholding_frames(frames, thresholding_method='Otsu Thresholding', number_of_thresholds=1):
+    """
+    Global thresholding of every frame. Optimal thresholding iterates from the previous frame's
+    threshold; Otsu and spectral thresholds are computed directly from the histogram (no iterations
+    to save), so they just reuse the cached single-pass machinery
+    """
+    if thresholding_method not in ('Otsu Thresholding', 'Optimal Thresholding', 'Spectral Thresholding'):
+        raise ValueError("Invalid method. Choose 'Otsu Thresholding', 'Optimal Thresholding', or 'Spectral Thresholding'.")
+
+    threshold = None
+    for frame in frames:
+        grayscale_frame = cv2.cvtColor(frame, cv2.COLOR_RGB2GRAY)
+        histogram = np.bincount(grayscale_frame.ravel(), minlength=256)
+
+        if thresholding_method == 'Optimal Thresholding':
+            if threshold is None:
+                threshold = ot.initial_threshold(grayscale_frame, histogram)
+            threshold = int(ot.calculate_new_threshold(histogram, threshold))
+            thresholds = [threshold]
+
+        elif thresholding_method == 'Otsu Thresholding':
+            thresholds = otsu.otsu_thresholds(histogram, number_of_thresholds)
+
+        else:
+            thresholds = st.spectral_thresholds(histogram, number_of_thresholds)
+
+        yield lt.apply_thresholds(grayscale_frame, thresholds)
+
+def mean_shift_frames(frames, spatial_bandwidth=0.1, color_bandwidth=0.1, sampling_ratio=0.1):
+    # Mean shift on every frame, sampling the same pixels and starting them from the previous modes
+    sample_mask, modes = None, None
+    for frame in frames:
+        segmented, sample_mask, modes = ms.mean_shift_segmentation(frame, spatial_bandwidth, color_bandwidth, sampling_ratio,
+                                                                   sample_mask=sample_mask, start_modes=modes,
+                                                                   return_modes=True)
+        yield segmented
+
+def segment_video(source, method, **settings):
+    # Segmented frames of source with one of the UI's method names, see the *_frames functions for the settings
+    frames = read_frames(source)
+    if method == "K-means Clustering":
+        return k_means_frames(frames, **settings)
+    elif method == "Mean Shift":
+        return mean_shift_frames(frames, **settings)
+    return thresholding_frames(frames, method, **settings)
+
+
+if __name__ == "__main__":
+    # python VideoSegmentation.py <video or frames> <output directory> [method]
+    source, output_directory = sys.argv[1], sys.argv[2]
+    method = sys.argv[3] if len(sys.argv) > 3 else "K-means Clustering"
+    os.makedirs(output_directory, exist_ok=True)
+    for index, segmented_frame in enumerate(segment_video(source, method)):
+        if segmented_frame.ndim == 3:
+            segmented_frame = cv2.cvtColor(segmented_frame, cv2.COLOR_RGB2BGR)
+        cv2.imwrite(os.path.join(output_directory, f"{index:05d}.png"), segmented_frame)
@@ -37,37 +37,67 @@ class MeanShiftWorker(QThread):
             self.progress.emit(f"Error: {str(e)}")
 
 
+# Gaussian weights above the 0.001 cutoff lie within this distance, in bandwidth units
+KERNEL_RADIUS = np.sqrt(2 * np.log(1000))
+LEAF_SIZE = 32
+
+
 @jit(nopython=True)
-def mean_shift_point(point, points, spatial_bandwidth, color_bandwidth):
+def mean_shift_point(point, points, tree, scales, spatial_bandwidth, color_bandwidth):
     """
-    Perform mean shift for a single point with separate spatial and color bandwidths
+    Perform mean shift for a single point with separate spatial and color bandwidths.
+    Only the KD-tree leaves within KERNEL_RADIUS of the point (in bandwidth units) are visited,
+    the points of every other leaf weigh less than the cutoff
     """
     shift = np.zeros_like(point, dtype=np.float64)
     total_weight = 0
     
-    # Separate spatial and color components
-    spatial_point = point[:2]
-    color_point = point[2:5]
+    lower, upper, starts, ends, children = tree
+    scaled_point = point / scales
+    # a little slack so no point within the cutoff is pruned by rounding
+    radius_squared = KERNEL_RADIUS * KERNEL_RADIUS * (1 + 1e-6)
     
-    for p in points:
-        # Separate spatial and color components
-        spatial_p = p[:2]
-        color_p = p[2:5]
+    stack = np.empty(128, dtype=np.int64)
+    stack[0] = 0
+    stack_size = 1
+    while stack_size > 0:
+        stack_size -= 1
+        node = stack[stack_size]
         
-        # Calculate distances in spatial and color spaces separately
-        spatial_dist = np.sqrt(np.sum((spatial_point - spatial_p)**2))
-        color_dist = np.sqrt(np.sum((color_point - color_p)**2))
+        # Squared distance from the point to the bounding box of the node
+        box_distance = 0.0
+        for dimension in range(len(scaled_point)):
+            if scaled_point[dimension] < lower[node, dimension]:
+                box_distance += (lower[node, dimension] - scaled_point[dimension])**2
+            elif scaled_point[dimension] > upper[node, dimension]:
+                box_distance += (scaled_point[dimension] - upper[node, dimension])**2
+        if box_distance > radius_squared:
+            continue
         
-        # Gaussian kernel with separate bandwidths
-        spatial_weight = np.exp(-0.5 * (spatial_dist / spatial_bandwidth)**2)
-        color_weight = np.exp(-0.5 * (color_dist / color_bandwidth)**2)
+        if children[node, 0] >= 0:
+            stack[stack_size] = children[node, 0]
+            stack[stack_size + 1] = children[node, 1]
+            stack_size += 2
+            continue
         
-        # Combined weight
-        weight = spatial_weight * color_weight
-        
-        if weight > 0.001:  # Only consider points with significant weight
-            shift += weight * p
-            total_weight += weight
+        for i in range(starts[node], ends[node]):
+            # Squared spatial and color distances, each in units of its own bandwidth
+            spatial_dist = 0.0
+            for dimension in range(2):
+                spatial_dist += ((point[dimension] - points[i, dimension]) / spatial_bandwidth)**2
+            color_dist = 0.0
+            for dimension in range(2, 5):
+                color_dist += ((point[dimension] - points[i, dimension]) / color_bandwidth)**2
+            if spatial_dist + color_dist > radius_squared:
+                continue
+            
+            # Gaussian kernel with separate bandwidths, combined
+            weight = np.exp(-0.5 * spatial_dist) * np.exp(-0.5 * color_dist)
+            
+            if weight > 0.001:  # Only consider points with significant weight
+                for dimension in range(5):
+                    shift[dimension] += weight * points[i, dimension]
+                total_weight += weight
     
     if total_weight > 0:
         shift /= total_weight
@@ -75,22 +105,83 @@ def mean_shift_point(point, points, spatial_bandwidth, color_bandwidth):
     else:
         return point
 
-@jit(nopython=True, parallel=True)
-def batch_mean_shift(points, spatial_bandwidth, color_bandwidth, max_iterations=20, epsilon=0.05):
+@jit(nopython=True)
+def build_kd_tree(points, leaf_size=LEAF_SIZE):
+    """
+    KD-tree over the points, split at the median of the widest dimension. Returns the order of the
+    points (every node covers a contiguous range of the reordered points) and per node its bounding
+    box, range and children (-1 for leaves)
+    """
+    n, dimensions = points.shape
+    max_nodes = 4 * (n // leaf_size + 1)
+    lower = np.empty((max_nodes, dimensions))
+    upper = np.empty((max_nodes, dimensions))
+    starts = np.empty(max_nodes, dtype=np.int64)
+    ends = np.empty(max_nodes, dtype=np.int64)
+    children = -np.ones((max_nodes, 2), dtype=np.int64)
+    order = np.arange(n)
+    
+    starts[0], ends[0] = 0, n
+    number_of_nodes = 1
+    stack = np.empty(128, dtype=np.int64)
+    stack[0] = 0
+    stack_size = 1
+    while stack_size > 0:
+        stack_size -= 1
+        node = stack[stack_size]
+        start, end = starts[node], ends[node]
+        
+        for dimension in range(dimensions):
+            values = points[order[start:end], dimension]
+            lower[node, dimension] = values.min()
+            upper[node, dimension] = values.max()
+        if end - start <= leaf_size:
+            continue
+        
+        split_dimension = np.argmax(upper[node] - lower[node])
+        segment = order[start:end]
+        order[start:end] = segment[np.argsort(points[segment, split_dimension])]
+        middle = (start + end) // 2
+        
+        for child, (child_start, child_end) in enumerate(((start, middle), (middle, end))):
+            starts[number_of_nodes], ends[number_of_nodes] = child_start, child_end
+            children[node, child] = number_of_nodes
+            stack[stack_size] = number_of_nodes
+            stack_size += 1
+            number_of_nodes += 1
+    
+    return order, (lower[:number_of_nodes], upper[:number_of_nodes], starts[:number_of_nodes],
+                   ends[:number_of_nodes], children[:number_of_nodes])
+
+def batch_mean_shift(points, spatial_bandwidth, color_bandwidth, max_iterations=20, epsilon=0.05, start_points=None):
     """
-    Perform mean shift for all points using separate spatial and color bandwidths
+    Perform mean shift for all points using separate spatial and color bandwidths.
+    start_points (same shape as points) starts the shifts from given positions, e.g. the modes
+    found on the previous video frame, instead of from the points themselves
     """
-    shifted_points = np.copy(points)
-    moving = np.ones(len(points), dtype=np.bool_)
+    shifted_points = np.copy(points) if start_points is None else np.array(start_points, dtype=np.float64)
+    
+    # Index the points in bandwidth units, where the truncated kernel is a ball of radius KERNEL_RADIUS
+    scales = np.array([spatial_bandwidth, spatial_bandwidth, color_bandwidth, color_bandwidth, color_bandwidth])
+    scaled_points = points / scales
+    order, tree = build_kd_tree(scaled_points)
+    
+    return shift_to_modes(points[order], tree, scales, shifted_points,
+                          spatial_bandwidth, color_bandwidth, max_iterations, epsilon)
+
+@jit(nopython=True, parallel=True)
+def shift_to_modes(points, tree, scales, shifted_points, spatial_bandwidth, color_bandwidth,
+                   max_iterations=20, epsilon=0.05):
+    moving = np.ones(len(shifted_points), dtype=np.bool_)
     iterations = 0
     
     while np.any(moving) and iterations < max_iterations:
         iterations += 1
         
-        for i in prange(len(points)):
+        for i in prange(len(shifted_points)):
             if moving[i]:
                 old_point = shifted_points[i].copy()
-                shifted_points[i] = mean_shift_point(shifted_points[i], points, spatial_bandwidth, color_bandwidth)
+                shifted_points[i] = mean_shift_point(shifted_points[i], points, tree, scales, spatial_bandwidth, color_bandwidth)
                 shift_dist = np.sqrt(np.sum((shifted_points[i] - old_point)**2))
                 moving[i] = shift_dist > epsilon
         
@@ -103,58 +194,49 @@ def assign_labels(img, shifted_points):
     Assign each pixel in the image to the closest shifted feature point
     """
     h, w, _ = img.shape
-    label_matrix = np.zeros((h, w), dtype=np.int32)
-    
-    # Dictionary to store pixel indices for each cluster
-    clusters = {}
     
     # First, assign each sampled point to a cluster based on shifted points
-    for i, shifted_point in enumerate(shifted_points):
-        # Round the color values to create discrete clusters
-        # Using only color components, not spatial
-        cluster_key = tuple(np.round(shifted_point[2:5] * 4) / 4)
-        
-        if cluster_key not in clusters:
-            clusters[cluster_key] = len(clusters)
-        
-    # Create mapping from shifted points to cluster indices
-    point_to_cluster = {}
-    for i, shifted_point in enumerate(shifted_points):
-        cluster_key = tuple(np.round(shifted_point[2:5] * 4) / 4)
-        point_to_cluster[i] = clusters[cluster_key]
+    # Round the color values to create discrete clusters
+    # Using only color components, not spatial
+    cluster_keys = np.round(shifted_points[:, 2:5] * 4) / 4
     
-    # Create a lookup array for cluster colors
-    cluster_colors = np.zeros((len(clusters), 3))
-    for cluster_key, cluster_idx in clusters.items():
-        cluster_colors[cluster_idx] = cluster_key
+    # Cluster colors in order of first appearance
+    _, first_indices = np.unique(cluster_keys, axis=0, return_index=True)
+    cluster_colors = cluster_keys[np.sort(first_indices)]
     
-    print(f"Created {len(clusters)} distinct color clusters")
+    print(f"Created {len(cluster_colors)} distinct color clusters")
     
     # Now, assign each pixel to the closest cluster
     normalized_img = img / 255.0
-    
-    for y in range(h):
-        for x in range(w):
-            pixel = normalized_img[y, x]
-            
-            # Find closest color cluster
-            min_dist = float('inf')
-            best_cluster = 0
-            
-            for cluster_idx, color in enumerate(cluster_colors):
-                dist = np.sum((pixel - color)**2)
-                if dist < min_dist:
-                    min_dist = dist
-                    best_cluster = cluster_idx
-            
-            label_matrix[y, x] = best_cluster
+    label_matrix = nearest_colors(normalized_img.reshape(-1, 3), cluster_colors).reshape(h, w)
     
     return label_matrix, cluster_colors
 
+@jit(nopython=True, parallel=True)
+def nearest_colors(pixels, colors):
+    """Index of the closest color for every pixel, one compiled pass instead of a Python loop per pixel"""
+    labels = np.empty(len(pixels), dtype=np.int32)
+    for i in prange(len(pixels)):
+        min_dist = np.inf
+        best_cluster = 0
+        for cluster_idx in range(len(colors)):
+            dist = 0.0
+            for channel in range(3):
+                dist += (pixels[i, channel] - colors[cluster_idx, channel])**2
+            if dist < min_dist:
+                min_dist = dist
+                best_cluster = cluster_idx
+        labels[i] = best_cluster
+    return labels
+
 
-def mean_shift_segmentation(img, spatial_bandwidth=0.1, color_bandwidth=0.1, sampling_ratio=0.1, boundary_thickness=2):
+def mean_shift_segmentation(img, spatial_bandwidth=0.1, color_bandwidth=0.1, sampling_ratio=0.1, boundary_thickness=2,
+                            sample_mask=None, start_modes=None, return_modes=False):
     """
-    Perform simplified mean shift segmentation with white boundaries
+    Perform simplified mean shift segmentation with white boundaries.
+    For frame sequences, the sample_mask and modes returned with return_modes=True can be passed
+    back in for the next frame: the same pixels are sampled and their shifts start from the
+    previous modes, so they converge in a couple of iterations when the frames are similar
     """
     # Limit the size of the image
     max_size = 500  # Maximum dimension (width or height)
@@ -168,11 +250,13 @@ def mean_shift_segmentation(img, spatial_bandwidth=0.1, color_bandwidth=0.1, sam
     purple_background = np.ones_like(img) * np.array([75, 35, 85])  # Approximate purple color
     
     # Downsample image for faster processing  
-    sample_mask = np.random.rand(h, w) < sampling_ratio
+    if sample_mask is None or sample_mask.shape != (h, w):
+        sample_mask = np.random.rand(h, w) < sampling_ratio
+        start_modes = None
     y_coords, x_coords = np.where(sample_mask)
     
     # Skip if we don't have enough sample points
-    if len(y_coords) < 100:
+    if len(y_coords) < 100 and start_modes is None:
         print("Warning: Not enough sample points, increasing sampling ratio")
         sampling_ratio = min(1.0, sampling_ratio * 2)
         sample_mask = np.random.rand(h, w) < sampling_ratio
@@ -196,7 +280,7 @@ def mean_shift_segmentation(img, spatial_bandwidth=0.1, color_bandwidth=0.1, sam
     start_time = time()
     
     # Apply mean shift to find shifted features
-    shifted_features = batch_mean_shift(features, spatial_bandwidth, color_bandwidth)
+    shifted_features = batch_mean_shift(features, spatial_bandwidth, color_bandwidth, start_points=start_modes)
     
     print(f"Mean shift completed in {time() - start_time:.2f} seconds")
     
@@ -211,11 +295,10 @@ def mean_shift_segmentation(img, spatial_bandwidth=0.1, color_bandwidth=0.1, sam
     _, foreground_mask = cv2.threshold(gray, 20, 255, cv2.THRESH_BINARY)
     foreground_mask = cv2.morphologyEx(foreground_mask, cv2.MORPH_CLOSE, np.ones((5,5), np.uint8))
     
-    # Apply cluster colors to segmented image
-    for y in range(h):
-        for x in range(w):
-            if foreground_mask[y, x] > 0:  # Only apply to foreground
-                cluster_idx = label_matrix[y, x]
-                segmented[y, x] = cluster_colors[cluster_idx] * 255
+    # Apply cluster colors to segmented image, only to the foreground
+    foreground = foreground_mask > 0
+    segmented[foreground] = cluster_colors[label_matrix[foreground]] * 255
 
+    if return_modes:
+        return segmented.astype(np.uint8), sample_mask, shifted_features
     return segmented.astype(np.uint8)